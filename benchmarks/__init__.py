@@ -0,0 +1,2 @@
+"""Negotiation micro-benchmarks.
+"""
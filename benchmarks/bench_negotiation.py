@@ -0,0 +1,261 @@
+""":mod:`benchmarks.bench_negotiation`
+======================================
+
+Micro-benchmarks of the negotiation hot paths.
+
+Run as a script to write results to JSON::
+
+    python -m benchmarks.bench_negotiation --json bench.json
+
+Or with pytest-benchmark::
+
+    py.test benchmarks/bench_negotiation.py --benchmark-json bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+from contextlib import contextmanager
+
+from flask import Flask, request
+
+import flask_negotiation
+from flask_negotiation import Render, provides
+from flask_negotiation.media_type import (parse_header, acceptable_media_types,
+                                          choose_media_type, best_renderer,
+                                          best_renderers, parse_accept,
+                                          accept_cache, MediaType,
+                                          RendererIndex)
+from flask_negotiation.renderers import renderer, json_renderer
+
+from corpus import CORPUS, accept_with_entries
+
+try:
+    import pytest
+except ImportError:
+    pytest = None
+
+
+RENDERER_COUNTS = (1, 3, 12)
+ENTRY_COUNTS = (1, 8, 64)
+
+SUPPORTED_TYPES = ('application/json', 'text/html', 'application/hal+json',
+                   'text/csv', 'application/msgpack', 'application/xml',
+                   'application/cbor', 'text/plain', 'application/x-ndjson',
+                   'application/vnd.api+json', 'image/png', 'text/*')
+
+app = Flask(__name__)
+
+
+def make_renderers(count):
+    """Creates `count` renderers of :data:`SUPPORTED_TYPES`.
+    """
+    renderers = [json_renderer]
+    for media_type in SUPPORTED_TYPES[1:count]:
+        @renderer(media_type)
+        def render(data, template=None, ctx=None):
+            return ''
+        renderers.append(render)
+    return renderers
+
+
+@contextmanager
+def request_context(accept):
+    headers = {} if accept is None else {'Accept': accept}
+    with app.test_request_context(headers=headers):
+        yield
+
+
+def headers():
+    """Yields name and value of every header to benchmark with.
+    """
+    for name, value in sorted(CORPUS.items()):
+        yield name, value
+    for count in ENTRY_COUNTS:
+        yield 'entries/%d' % count, accept_with_entries(count)
+
+
+def cases():
+    """Yields ``(name, params, accept, factory)`` of benchmark cases.
+    `factory` is called in a request context and returns the function to
+    measure.
+    """
+    for header, accept in headers():
+        params = {'header': header}
+
+        def parse(accept=accept):
+            entries = (accept or '*/*').split(',')
+            return lambda: [parse_header(x) for x in entries]
+        yield 'parse_header', params, accept, parse
+
+        def acceptables(cache):
+            app.config['NEGOTIATION_ACCEPT_CACHE'] = cache
+
+            def parse():
+                # Forget the per-request result to measure parsing itself
+                request.environ.pop('flask_negotiation.accept', None)
+                return acceptable_media_types(request)
+            return parse
+        for cache in (False, True):
+            yield ('acceptable_media_types',
+                   dict(params, cache=cache), accept,
+                   lambda cache=cache: acceptables(cache))
+
+        def choose():
+            app.config['NEGOTIATION_ACCEPT_CACHE'] = True
+            supported = map(MediaType, SUPPORTED_TYPES)
+            acceptables = acceptable_media_types(request)
+            return lambda: choose_media_type(acceptables, supported)
+        yield 'choose_media_type', params, accept, choose
+
+        for count in RENDERER_COUNTS:
+            def best(count=count):
+                renderers = make_renderers(count)
+                acceptables = acceptable_media_types(request)
+                return lambda: best_renderer(renderers, acceptables)
+            yield ('best_renderer', dict(params, renderers=count), accept,
+                   best)
+
+            def indexed(count=count):
+                index = RendererIndex(make_renderers(count))
+                acceptables = acceptable_media_types(request)
+                return lambda: best_renderer(index, acceptables)
+            yield ('best_renderer', dict(params, renderers=count, index=True),
+                   accept, indexed)
+
+            def render(count=count):
+                render = Render(renderers=make_renderers(count))
+                data = {'key': 'value'}
+                return lambda: render(data)
+            yield 'Render.__call__', dict(params, renderers=count), accept, \
+                render
+
+        def client():
+            provided = provides(*SUPPORTED_TYPES)(lambda: 'OK')
+            endpoint = 'provides_%d' % len(app.view_functions)
+            app.add_url_rule('/' + endpoint, endpoint, provided)
+            client = app.test_client()
+            environ = {} if accept is None else {'HTTP_ACCEPT': accept}
+            return lambda: client.get('/' + endpoint, environ_base=environ)
+        yield 'provides', params, accept, client
+
+    # A gateway negotiating the whole corpus, each header repeated
+    batch = [value for _, value in headers()] * 10
+    params = {'header': 'batch/%d' % len(batch)}
+    for count in RENDERER_COUNTS:
+        def one_by_one(count=count):
+            index = RendererIndex(make_renderers(count))
+            return lambda: [
+                best_renderer(index, accept_cache.get_or_create(
+                    value, parse_accept))
+                for value in batch]
+        yield ('best_renderer', dict(params, renderers=count, index=True),
+               None, one_by_one)
+
+        def bulk(count=count):
+            index = RendererIndex(make_renderers(count))
+            return lambda: best_renderers(batch, index)
+        yield 'best_renderers', dict(params, renderers=count), None, bulk
+
+
+def case_id(name, params):
+    return '%s[%s]' % (name, ','.join('%s=%s' % item
+                                      for item in sorted(params.items())))
+
+
+def version():
+    """Returns installed version of the distribution or :const:`None`.
+    """
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('Flask-Negotiation').version
+    except Exception:
+        return None
+
+
+def revision():
+    """Returns git revision of the benchmarked source tree, suffixed with
+    ``-dirty`` if it has uncommitted changes, or :const:`None`.
+    """
+    cwd = os.path.dirname(os.path.abspath(flask_negotiation.__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            rev = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                          cwd=cwd, stderr=devnull).strip()
+            dirty = subprocess.check_output(
+                ['git', 'status', '--porcelain', '--untracked-files=no'],
+                cwd=cwd, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return rev + '-dirty' if dirty else rev
+
+
+def run(number=1000, repeat=3, match=None):
+    """Runs every case and returns results as a JSON-serializable dict.
+    """
+    results = []
+    for name, params, accept, factory in cases():
+        id = case_id(name, params)
+        if match and match not in id:
+            continue
+        with request_context(accept):
+            fn = factory()
+            try:
+                fn()
+            except Exception as e:
+                results.append({'name': name, 'params': params,
+                                'error': repr(e)})
+                continue
+            timings = timeit.repeat(fn, number=number, repeat=repeat)
+        results.append({
+            'name': name,
+            'params': params,
+            'number': number,
+            'best_us': min(timings) / number * 1e6,
+            'mean_us': sum(timings) / len(timings) / number * 1e6,
+        })
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'version': version(),
+        'revision': revision(),
+        'speedups': flask_negotiation.media_type.speedups,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[3])
+    parser.add_argument('--json', metavar='PATH',
+                        help='write results to PATH instead of stdout')
+    parser.add_argument('--number', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--match', help='run cases containing MATCH only')
+    args = parser.parse_args(argv)
+    results = run(args.number, args.repeat, args.match)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        for result in results['results']:
+            print('%-80s %s' % (case_id(result['name'], result['params']),
+                                result.get('error') or
+                                '%10.2fus' % result['best_us']))
+
+
+if pytest is not None:
+    @pytest.mark.parametrize(
+        ('name', 'params', 'accept', 'factory'), list(cases()),
+        ids=[case_id(name, params) for name, params, _, _ in cases()])
+    def test_negotiation(benchmark, name, params, accept, factory):
+        benchmark.name = case_id(name, params)
+        benchmark.extra_info.update(params)
+        with request_context(accept):
+            benchmark(factory())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+""":mod:`benchmarks.corpus`
+===========================
+
+`Accept` headers seen in the wild, grouped by client kind.
+"""
+
+BROWSERS = {
+    'chrome': 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+              'image/avif,image/webp,image/apng,*/*;q=0.8,'
+              'application/signed-exchange;v=b3;q=0.7',
+    'firefox': 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+               'image/avif,image/webp,*/*;q=0.8',
+    'safari': 'text/html,application/xhtml+xml,application/xml;q=0.9,'
+              '*/*;q=0.8',
+    'edge_legacy': 'text/html, application/xhtml+xml, image/jxr, */*',
+    'ie8': 'image/jpeg, application/x-ms-application, image/gif, '
+           'application/xaml+xml, image/pjpeg, application/x-ms-xbap, '
+           'application/x-shockwave-flash, application/msword, */*',
+}
+
+TOOLS = {
+    'curl': '*/*',
+    'missing': None,
+    'wget': '*/*',
+}
+
+API_CLIENTS = {
+    'json': 'application/json',
+    'axios': 'application/json, text/plain, */*',
+    'github': 'application/vnd.github+json',
+    'hal': 'application/hal+json, application/json;q=0.9',
+    'msgpack': 'application/msgpack, application/x-msgpack;q=0.9, '
+               'application/json;q=0.5',
+}
+
+PATHOLOGICAL = {
+    'many_entries': ', '.join('application/x-type%d;q=0.%d' % (i, i % 10)
+                              for i in range(60)),
+    'many_params': 'text/html;' + ';'.join('p%d=v%d' % (i, i)
+                                           for i in range(200)),
+    'quoted': ', '.join('text/html;title="a, b; \\"c\\"";q=0.%d' % (i % 10)
+                        for i in range(30)),
+    'unterminated_quote': 'text/html;x="' + 'a,;' * 1000,
+}
+
+#: Every header by ``kind/name``.
+CORPUS = dict(('%s/%s' % (kind, name), value)
+              for kind, headers in (('browser', BROWSERS),
+                                    ('tool', TOOLS),
+                                    ('api', API_CLIENTS),
+                                    ('pathological', PATHOLOGICAL))
+              for name, value in headers.items())
+
+
+def accept_with_entries(count):
+    """Synthetic header with `count` entries of decreasing quality.
+    """
+    entries = ['application/x-type%d;q=%.3f' % (i, 1 - i / 1000.0)
+               for i in range(count - 1)]
+    return ', '.join(entries + ['*/*;q=0.001'])
@@ -3,24 +3,106 @@
 
 Provides better content-negotiation for flask.
 """
-from flask import Response, request, abort
+import hashlib
+import weakref
 
+from flask import Response, request, abort, current_app
+from werkzeug.http import is_resource_modified
+
+import signals
+from cache import LRUCache
+from compression import Compressor
 from renderers import TemplateRenderer
-from decorators import provides
-from media_type import acceptable_media_types, best_renderer, MediaType
+from decorators import provides, accepts, _provider
+from media_type import (acceptable_media_types, acceptable_encodings,
+                        best_renderer, choose_encoding, MediaType,
+                        RendererIndex)
 
-__all__ = ('Render', 'MediaType', 'provides')
+__all__ = ('Render', 'Negotiation', 'MediaType', 'provides', 'accepts')
 
 
 class Render(object):
     """Dynamic function class renders content.
+
+    Negotiated decisions are memoized per `Accept` header and renderers in a
+    bounded cache of `decision_cache_size` entries.
+
+    With `stream`, renderers providing ``render_iter`` stream the body in
+    chunks instead of rendering it at once.  :const:`None` streams with
+    renderers whose ``streaming`` is set only.
+
+    With `etag`, responses carry a strong ETag per negotiated variant and
+    conditional GET requests are answered with HTTP 304 (Not Modified).
+
+    Responses always vary on `Accept`.  `content_location` is a function
+    takes negotiated media type and returns URL of the variant, and
+    ``cache_control`` of the chosen renderer becomes `Cache-Control` unless
+    `headers` already has one.
+
+    `cache` is a backend such as :class:`~cache.MemoryCache` that keeps
+    rendered bodies of calls given `cache_key` per negotiated media type.
+
+    `compress` negotiates `Accept-Encoding` too and compresses bodies with
+    :class:`~compression.Compressor`.  :const:`True` uses the default one.
+
+    `offload` is an :class:`~offload.OffloadPolicy` that renders large
+    payloads on a thread or process pool.
     """
-    def __init__(self, renderers=(TemplateRenderer(), )):
+    def __init__(self, renderers=(TemplateRenderer(), ),
+                 decision_cache_size=256, stream=None, etag=False,
+                 content_location=None, cache=None, compress=False,
+                 offload=None):
         super(Render, self).__init__()
+        self.offload = offload
+        self.decisions = LRUCache(maxsize=decision_cache_size)
+        self.stream = stream
+        self.etag = etag
+        self.content_location = content_location
+        self.cache = cache
+        if compress is True:
+            compress = Compressor()
+        self.compressor = compress or None
         self.renderers = renderers
 
+    @property
+    def renderers(self):
+        """Default renderers.  Assigning it invalidates decisions.
+        """
+        return self._renderers
+
+    @renderers.setter
+    def renderers(self, renderers):
+        self._renderers = tuple(renderers)
+        self.invalidate()
+
+    def invalidate(self):
+        """Forgets memoized decisions and rebuilds :attr:`index`.  Call it
+        after changing renderers or their media types in place.
+        """
+        self.index = RendererIndex(self._renderers)
+        self.decisions.clear()
+
+    def negotiate(self, renderers=None):
+        """Chooses renderer and media type for current request.
+
+        :returns: pair of renderer and media type or ``(None, None)`` if
+            nothing is acceptable.
+        """
+        renderers = tuple(renderers or self.renderers)
+        key = (request.headers.get('accept', None), renderers)
+        decision = self.decisions.get(key)
+        if decision is None:
+            media_types = acceptable_media_types(request)
+            if renderers == self.index.renderers:
+                renderers = self.index
+            decision = best_renderer(renderers, media_types)
+            self.decisions.set(key, decision)
+        return decision
+
     def __call__(self, data, template=None, status=200, headers=None,
-                 renderers=None, ctx=None):
+                 renderers=None, ctx=None, stream=None, etag=None,
+                 version=None, last_modified=None, content_location=None,
+                 cache_key=None, ttl=None):
         """Render `_data` to response.
 
         :param data: rendering target.
@@ -31,6 +113,23 @@ class Render(object):
             default renderers
         :param ctx: context for template renderer.  defualt is
             `{'data':data}`
+        :param stream: streams the body if the renderer can.  :const:`None`
+            to use default of the instance
+        :param etag: adds ETag and answers conditional requests.
+            :const:`None` to use default of the instance
+        :param version: cheap version key of `data` such as its update time.
+            the ETag derives from it instead of the rendered body, so
+            unmodified variants are answered before rendering.
+        :param last_modified: :class:`~datetime.datetime` of last
+            modification of `data` for `If-Modified-Since`
+        :param content_location: URL of the variant or function returns it
+            from negotiated media type.  :const:`None` to use default of the
+            instance
+        :param cache_key: key of rendered body in the response cache.
+            :const:`True` to derive it from endpoint, path and query string.
+            :const:`None` not to cache
+        :param ttl: seconds to keep rendered body in the response cache.
+            :const:`None` to use default of the cache
 
         :returns: rendered response
         :rtype: :class:`flask.Response`
@@ -68,11 +167,254 @@ class Render(object):
                 })
 
         """
-        renderers = renderers or self.renderers
-        media_types = acceptable_media_types(request)
-        renderer, rendered_media_type = best_renderer(renderers, media_types)
+        timings = None
+        if signals.receiving(signals.rendered):
+            # 'total' holds the start time until :meth:`_finish`
+            timings = {'total': signals.timer()}
+        renderer, rendered_media_type = self.negotiate(renderers)
+        if timings is not None:
+            timings['negotiate'] = signals.timer() - timings['total']
         if renderer is None:
+            if signals.receiving(signals.not_acceptable):
+                signals.not_acceptable.send(
+                    self, accept=request.headers.get('Accept'))
             abort(406)
-        body = renderer.render(data, template, ctx)
-        return Response(body, status, headers, unicode(rendered_media_type),
-                        content_type=unicode(rendered_media_type))
+        if stream is None:
+            stream = self.stream
+        if stream is None:
+            stream = renderer.streaming
+        if etag is None:
+            etag = self.etag
+        conditional = (etag and status == 200 and
+                       request.method in ('GET', 'HEAD'))
+        tag = None
+        if conditional and version is not None:
+            tag = _digest(repr((version, unicode(rendered_media_type),
+                                template)))
+        encoding = None
+        if self.compressor is not None:
+            encoding = choose_encoding(acceptable_encodings(request),
+                                       self.compressor.encodings)
+        if conditional and (tag is not None or last_modified is not None):
+            for candidate in _variant_tags(tag, encoding):
+                if not is_resource_modified(request.environ, candidate,
+                                            last_modified=last_modified):
+                    response = Response(status=304, headers=headers)
+                    _set_validators(response, candidate, last_modified)
+                    return self._finish(response, renderer,
+                                        rendered_media_type,
+                                        content_location, timings)
+        cache = self.cache
+        if cache_key is None or request.method not in ('GET', 'HEAD'):
+            cache = None
+        elif cache_key is True:
+            cache_key = u'%s:%s' % (request.endpoint, request.full_path)
+        if cache is not None:
+            cache_key = u'%s|%s' % (cache_key, rendered_media_type)
+            body = cache.get(cache_key)
+        else:
+            body = None
+        if body is None:
+            if timings is not None:
+                rendering = signals.timer()
+            body = self._render(renderer, data, template, ctx,
+                                stream and cache is None)
+            if timings is not None:
+                timings['render'] = signals.timer() - rendering
+            if cache is not None:
+                body = _encode(body)
+                cache.set(cache_key, body, ttl)
+        response = Response(body, status, headers,
+                            unicode(rendered_media_type),
+                            content_type=unicode(rendered_media_type))
+        if etag and tag is None and not response.is_streamed:
+            tag = _digest(response.get_data())
+        if encoding is not None and self._compress(response, encoding) and \
+                tag is not None:
+            tag = _variant_tags(tag, encoding)[-1]
+        if etag:
+            _set_validators(response, tag, last_modified)
+            if conditional:
+                response.make_conditional(request)
+        return self._finish(response, renderer, rendered_media_type,
+                            content_location, timings)
+
+    def _render(self, renderer, data, template, ctx, stream):
+        render_iter = getattr(renderer, 'render_iter', None)
+        if stream and render_iter is not None:
+            return render_iter(data, template, ctx)
+        offload = self.offload
+        if offload is not None and offload.should_offload(renderer, data):
+            return offload.render(renderer, data, template, ctx)
+        return renderer.render(data, template, ctx)
+
+    def _compress(self, response, encoding):
+        """Compresses body of `response` if it is large enough.
+        """
+        if response.is_streamed or 'Content-Encoding' in response.headers:
+            return False
+        body = response.get_data()
+        if len(body) < self.compressor.min_size:
+            return False
+        response.set_data(self.compressor.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return True
+
+    def invalidate_cache(self, prefix):
+        """Removes rendered bodies whose cache key starts with `prefix` from
+        the response cache.
+        """
+        return self.cache.delete_prefix(prefix)
+
+    def _finish(self, response, renderer, media_type, content_location,
+                timings):
+        """Adds variant headers to `response` and sends
+        :data:`~signals.rendered` if `timings` is collected.
+        """
+        response.vary.add('Accept')
+        if self.compressor is not None:
+            response.vary.add('Accept-Encoding')
+        if content_location is None:
+            content_location = self.content_location
+        if callable(content_location):
+            content_location = content_location(media_type)
+        if content_location is not None:
+            response.content_location = content_location
+        cache_control = getattr(renderer, 'cache_control', None)
+        if cache_control and 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = cache_control
+        if timings is not None:
+            timings['total'] = signals.timer() - timings['total']
+            size = None if response.is_streamed else \
+                response.calculate_content_length()
+            signals.rendered.send(self, renderer=renderer,
+                                  media_type=media_type, response=response,
+                                  size=size, timings=timings)
+        return response
+
+
+class Negotiation(object):
+    """Flask extension keeps a registry of renderers for an application
+    and overrides of its blueprints::
+
+        negotiation = Negotiation(renderers=[TemplateRenderer(),
+                                             JSONRenderer()], etag=True)
+        negotiation.override('api', renderers=[JSONRenderer()])
+        negotiation.init_app(app)
+
+        @api.route('/users/<uid>')
+        @negotiation.provides()
+        def user(uid):
+            return negotiation.render(get_user(uid), 'user/read')
+
+    :meth:`init_app` builds a :class:`Render` with `options` for the
+    application and each overridden blueprint once, so their renderer
+    indexes and caches are shared by every request instead of being set up
+    per call.  With `warm_templates`, it also compiles templates of the
+    application and blueprints registered so far for every
+    :class:`~renderers.TemplateRenderer`.
+    """
+    def __init__(self, app=None, renderers=(TemplateRenderer(), ),
+                 warm_templates=False, **options):
+        super(Negotiation, self).__init__()
+        self.renderers = tuple(renderers)
+        self.warm_templates = warm_templates
+        self.options = options
+        self.overrides = {}
+        self._apps = weakref.WeakSet()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['negotiation'] = renders = {
+            None: Render(self.renderers, **self.options),
+        }
+        for name in self.overrides:
+            renders[name] = self._make_render(name)
+        self._apps.add(app)
+        self._init_renderers(app, renders.values(), self.warm_templates)
+
+    def _init_renderers(self, app, renders, warm=False):
+        renderers = set(x for render in renders for x in render.renderers
+                        if isinstance(x, TemplateRenderer))
+        for renderer in renderers:
+            renderer.init_app(app)
+            if warm:
+                renderer.warm(app)
+
+    def override(self, blueprint, renderers=None, **options):
+        """Overrides renderers or options of `blueprint`, a
+        :class:`~flask.Blueprint` or its name.  Views of nested blueprints
+        use the override of the nearest one.
+        """
+        name = getattr(blueprint, 'name', blueprint)
+        self.overrides[name] = renderers, options
+        for app in self._apps:
+            render = app.extensions['negotiation'][name] = \
+                self._make_render(name)
+            self._init_renderers(app, [render])
+
+    def _make_render(self, name):
+        renderers, options = self.overrides[name]
+        if renderers is None:
+            renderers = self.renderers
+        return Render(renderers, **dict(self.options, **options))
+
+    def get_render(self, app=None, blueprint=None):
+        """Returns :class:`Render` of `blueprint` in `app`.  Defaults are
+        current application and blueprint of current request.
+        """
+        renders = (app or current_app).extensions['negotiation']
+        if blueprint is not None:
+            names = [blueprint]
+        elif request:
+            names = getattr(request, 'blueprints', None) or \
+                [request.blueprint]
+        else:
+            names = []
+        for name in names:
+            render = renders.get(name)
+            if render is not None:
+                return render
+        return renders[None]
+
+    def render(self, data, template=None, **kwargs):
+        """Renders like :meth:`Render.__call__` with :meth:`get_render`.
+        """
+        return self.get_render()(data, template, **kwargs)
+
+    def provides(self, *media_types, **kwargs):
+        """Decorator like :func:`~decorators.provides`.  Without media
+        types, the view provides those of the renderers registered for it
+        and reuses negotiated decisions of :meth:`get_render`.
+        """
+        if media_types:
+            return provides(*media_types, **kwargs)
+        return _provider(lambda: self.get_render().negotiate()[1],
+                         kwargs.get('to'))
+
+
+def _encode(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _digest(s):
+    return hashlib.sha1(_encode(s)).hexdigest()
+
+
+def _variant_tags(tag, encoding):
+    """ETags a client may hold for a variant: one of the identity body and
+    one of the `encoding` body.
+    """
+    if tag is None or encoding is None:
+        return [tag]
+    return [tag, u'%s-%s' % (tag, encoding)]
+
+
+def _set_validators(response, tag, last_modified):
+    if tag is not None:
+        response.set_etag(tag)
+    if last_modified is not None:
+        response.last_modified = last_modified
@@ -0,0 +1,104 @@
+# cython: language_level=2
+""":mod:`_speedups`
+===================
+
+Compiled parsing and matching core of :mod:`media_type`.  It behaves
+exactly like the pure Python functions it replaces.
+"""
+
+
+cdef list _split(unicode s, Py_UCS4 separator, Py_ssize_t limit):
+    """Splits `s` by `separator` outside of quoted strings.  Quoted strings
+    end at a closing quote, at the end of `s` or before a backslash that
+    escapes nothing, as ``media_type._token_re`` does.
+    """
+    cdef Py_ssize_t i = 0, start = 0, n = len(s)
+    cdef Py_UCS4 c
+    cdef list parts = []
+    while i < n:
+        c = s[i]
+        if c == u'"':
+            i += 1
+            while i < n:
+                c = s[i]
+                if c == u'"':
+                    i += 1
+                    break
+                if c == u'\\':
+                    if i + 1 >= n or s[i + 1] == u'\n':
+                        break
+                    i += 2
+                else:
+                    i += 1
+        elif c == separator:
+            parts.append(s[start:i])
+            i += 1
+            start = i
+            if limit >= 0 and len(parts) >= limit:
+                raise ValueError('too many parts in header')
+        else:
+            i += 1
+    parts.append(s[start:])
+    return parts
+
+
+def split_header(s, separator, limit=None):
+    """Splits `s` by `separator` outside of quoted strings in a single pass.
+
+    :raises ValueError: when there are more than `limit` parts.
+    """
+    cdef Py_ssize_t bound = -1 if limit is None else limit
+    if isinstance(s, unicode):
+        return _split(s, ord(separator), bound)
+    # latin-1 maps bytes to code points one to one
+    return [x.encode('latin-1')
+            for x in _split(s.decode('latin-1'), ord(separator), bound)]
+
+
+cdef _unescape(value):
+    if '\\' not in value:
+        return value
+    cdef list chars = []
+    cdef Py_ssize_t i = 0, n = len(value)
+    while i < n:
+        if value[i] == '\\' and i + 1 < n and value[i + 1] != '\n':
+            i += 1
+        chars.append(value[i])
+        i += 1
+    return value[:0].join(chars)
+
+
+def parse_header_items(s):
+    cdef list params = [x.strip() for x in split_header(s, ';')]
+    cdef list items = []
+    cdef Py_ssize_t i
+    key = params.pop(0).lower()
+    for param in params:
+        i = param.find('=')
+        if i >= 0:
+            name = param[:i].strip().lower()
+            value = param[i+1:].strip()
+            if len(value) >= 2 and value[0] == value[-1] == '"':
+                value = _unescape(value[1:-1])
+            items.append((name, value))
+    return key, items
+
+
+def quality(items):
+    for k, v in items:
+        if k == 'q':
+            return float(v)
+    return 1.0
+
+
+def contains(media_type, other):
+    main_type = media_type.main_type
+    sub_type = media_type.sub_type
+    for k, v in media_type.param_items:
+        if k != 'q' and other.get_param(k) != v:
+            return False
+    if main_type == '*':
+        return sub_type == '*' or sub_type == other.sub_type
+    if sub_type == '*':
+        return main_type == other.main_type
+    return main_type == other.main_type and sub_type == other.sub_type
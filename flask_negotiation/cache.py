@@ -0,0 +1,186 @@
+""":mod:`cache`
+===============
+
+Caches shared by negotiation
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe, size-bounded least-recently-used cache.
+
+    A `maxsize` of ``0`` disables the cache: nothing is stored and every
+    lookup is a miss.
+    """
+    def __init__(self, maxsize=128):
+        super(LRUCache, self).__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns cached value of `key` or `default`.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Stores `value` as `key`, evicting least recently used items.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            if self.maxsize <= 0:
+                return
+            self._data[key] = value
+            self._evict()
+
+    def get_or_create(self, key, factory):
+        """Returns cached value of `key`, or stores and returns
+        ``factory(key)`` when it is missing.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = factory(key)
+            self.set(key, value)
+        return value
+
+    def resize(self, maxsize):
+        """Changes bound of the cache.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def clear(self):
+        """Removes all items and resets counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def _evict(self):
+        while len(self._data) > max(self.maxsize, 0):
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def stats(self):
+        """Dictionary of hit, miss and eviction counts.
+        """
+        with self._lock:
+            return self._stats()
+
+    def _stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryCache(LRUCache):
+    """In-memory cache of rendered bodies with LRU and TTL eviction.
+
+    It is bounded by `maxsize` entries and `max_bytes` of values, which
+    should be :class:`bytes`.  Entries live for `ttl` seconds unless
+    :meth:`set` gives another one; :const:`None` keeps them until they are
+    evicted.
+
+    Response cache backends of :class:`~flask_negotiation.Render`
+    implement ``get(key)``, ``set(key, value, ttl=None)`` and
+    ``delete_prefix(prefix)`` with string keys and :class:`bytes` values, so
+    a Redis client wrapper can stand in for this class.
+    """
+    def __init__(self, maxsize=1024, max_bytes=64 * 1024 * 1024, ttl=None,
+                 clock=time.time):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.expirations = 0
+        self.bytes = 0
+        super(MemoryCache, self).__init__(maxsize=maxsize)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.clock():
+                self.bytes -= len(value)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data[key] = expires, value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            self._discard(key)
+            if self.maxsize <= 0 or len(value) > self.max_bytes:
+                return
+            self._data[key] = expires, value
+            self.bytes += len(value)
+            self._evict()
+
+    def delete_prefix(self, prefix):
+        """Removes entries whose key starts with `prefix`.
+
+        :returns: number of removed entries.
+        """
+        with self._lock:
+            keys = [key for key in self._data if key.startswith(prefix)]
+            for key in keys:
+                self._discard(key)
+            return len(keys)
+
+    def clear(self):
+        super(MemoryCache, self).clear()
+        with self._lock:
+            self.bytes = self.expirations = 0
+
+    def _discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def _evict(self):
+        while self._data and (len(self._data) > self.maxsize or
+                              self.bytes > self.max_bytes):
+            key, (expires, value) = self._data.popitem(last=False)
+            self.bytes -= len(value)
+            self.evictions += 1
+
+    def _stats(self):
+        stats = super(MemoryCache, self)._stats()
+        lookups = self.hits + self.misses
+        stats.update(bytes=self.bytes, max_bytes=self.max_bytes,
+                     expirations=self.expirations,
+                     hit_rate=float(self.hits) / lookups if lookups else 0.0)
+        return stats
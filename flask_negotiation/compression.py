@@ -0,0 +1,76 @@
+""":mod:`compression`
+=====================
+
+Content codings of rendered bodies
+"""
+import gzip
+import hashlib
+import io
+import zlib
+from collections import OrderedDict
+
+from cache import MemoryCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(data, level=6):
+    """Compresses `data` to gzip format without timestamp, so same data
+    always gives same bytes.
+    """
+    buf = io.BytesIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def deflate_compress(data, level=6):
+    """Compresses `data` to zlib format.
+    """
+    return zlib.compress(data, level)
+
+
+#: Compress functions by content coding in order of preference.
+compressors = OrderedDict()
+if brotli is not None:
+    compressors['br'] = brotli.compress
+compressors['gzip'] = gzip_compress
+compressors['deflate'] = deflate_compress
+
+
+class Compressor(object):
+    """Compresses bodies, keeping results of recently compressed bodies in
+    a cache keyed by digest of the body, bounded by number and total size
+    of compressed bodies.
+    """
+    def __init__(self, min_size=1024, cache_size=256,
+                 compressors=compressors, cache_bytes=32 * 1024 * 1024):
+        """:param min_size: bodies shorter than it are not compressed.
+        :param cache_size: maximum number of compressed bodies kept.
+        :param compressors: compress functions by content coding in order
+            of preference.
+        :param cache_bytes: maximum total bytes of compressed bodies kept.
+        """
+        super(Compressor, self).__init__()
+        self.min_size = min_size
+        self.compressors = compressors
+        self.cache = MemoryCache(maxsize=cache_size, max_bytes=cache_bytes)
+
+    @property
+    def encodings(self):
+        """Supported content codings in order of preference.
+        """
+        return tuple(self.compressors)
+
+    def compress(self, data, encoding):
+        """Compresses `data` with content coding `encoding`.
+        """
+        key = hashlib.sha1(data).digest(), encoding
+        return self.cache.get_or_create(
+            key, lambda key: self.compressors[encoding](data))
@@ -3,11 +3,14 @@
 """
 from functools import wraps
 
-from flask import request
-from werkzeug.exceptions import NotAcceptable
+from flask import request, after_this_request
+from werkzeug.exceptions import (BadRequest, NotAcceptable,
+                                 UnsupportedMediaType, RequestEntityTooLarge)
 
+import signals
 from renderers import Renderer
-from media_type import acceptable_media_types, MediaType, choose_media_type
+from parsers import Parser
+from media_type import acceptable_media_types, MediaType, MediaTypeIndex
 
 
 def provides(media_type, *args, **kwargs):
@@ -50,6 +53,9 @@ def provides(media_type, *args, **kwargs):
             return str(provide_type)
 
     `to` does *not* guarantee same media type with `render` function.
+
+    Return value of the view is passed through unchanged, and its response
+    varies on `Accept`.
     """
     to = kwargs.get('to', None)
     # Collect media types
@@ -63,17 +69,104 @@ def provides(media_type, *args, **kwargs):
             media_types += media_type.media_types
         else:
             media_types.append(MediaType(media_type))
+    index = MediaTypeIndex(media_types)
+    return _provider(lambda: index.choose(acceptable_media_types(request)),
+                     to)
+
 
-    # Decorator here
+def _provider(choose, to):
+    """Returns decorator of :func:`provides` that responds with media type
+    `choose` returns or HTTP 406 (Not Acceptable) if it returns
+    :const:`None`.
+    """
     def decorator(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            acceptables = acceptable_media_types(request)
-            acceptable = choose_media_type(acceptables, media_types)
+            timings = None
+            if signals.receiving(signals.provided):
+                timings = {}
+                started = signals.timer()
+            acceptable = choose()
             if acceptable is None:
+                if signals.receiving(signals.not_acceptable):
+                    signals.not_acceptable.send(
+                        fn, accept=request.headers.get('Accept'))
                 raise NotAcceptable()
             if not to is None:
                 kwargs.update({to: acceptable})
+            if timings is not None:
+                timings['negotiate'] = signals.timer() - started
+            rv = fn(*args, **kwargs)
+            if timings is not None:
+                timings['total'] = signals.timer() - started
+                timings['view'] = timings['total'] - timings['negotiate']
+
+            @after_this_request
+            def vary(response):
+                response.vary.add('Accept')
+                if timings is not None:
+                    signals.provided.send(fn, media_type=acceptable,
+                                          response=response, timings=timings)
+                return response
+            return rv
+        return wrapper
+    return decorator
+
+
+def accepts(parser, *args, **kwargs):
+    """Decorator that parses request body with a parser chosen by
+    `Content-Type`, like :func:`provides` does with `Accept`.
+    For example::
+
+        from flask.ext.negotiation.decorators import accepts
+        from flask.ext.negotiation.parsers import json_parser, form_parser
+
+        @app.route('/users', methods=['POST'])
+        @accepts(json_parser, form_parser, to='user')
+        def create_user(user):
+            ...
+
+    Parsed body is given to keyword argument named `to` (default
+    ``'data'``).  It returns HTTP 415 (Unsupported Media Type) if no parser
+    supports the body and HTTP 413 (Request Entity Too Large) if it is
+    longer than `max_length` bytes.
+
+    With `stream`, parsers that can decode incrementally give an iterator of
+    decoded objects instead, which reads the body as it is consumed.
+    """
+    to = kwargs.get('to', 'data')
+    max_length = kwargs.get('max_length', None)
+    stream = kwargs.get('stream', False)
+    parsers = []
+    for parser in (parser, ) + args:
+        if isinstance(parser, type) and issubclass(parser, Parser):
+            parser = parser()
+        parsers.append(parser)
+    entries = [(parser, media_type)
+               for parser in parsers for media_type in parser.media_types]
+    index = MediaTypeIndex(media_type for _, media_type in entries)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            try:
+                content_type = MediaType.parse(
+                    request.headers.get('Content-Type', ''))
+            except ValueError:
+                raise BadRequest('Malformed Content-Type header.')
+            positions = index.positions(content_type)
+            if not positions:
+                raise UnsupportedMediaType()
+            parser = entries[positions[0]][0]
+            content_length = request.content_length
+            if max_length is not None and content_length is not None and \
+                    content_length > max_length:
+                raise RequestEntityTooLarge()
+            parse = parser.parse
+            if stream:
+                parse = getattr(parser, 'parse_iter', parse)
+            kwargs[to] = parse(request.stream, content_type, content_length,
+                               max_length)
             return fn(*args, **kwargs)
         return wrapper
     return decorator
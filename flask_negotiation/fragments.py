@@ -0,0 +1,77 @@
+""":mod:`fragments`
+===================
+
+Caches rendered fragments of Jinja templates::
+
+    {% cache 'item-card', 300, item.id, item.updated_at %}
+        ... expensive markup of item ...
+    {% endcache %}
+
+The first argument is the key of the fragment and the second is seconds to
+keep it, ``none`` to use the default of the cache.  Other arguments are
+the parts of the context the fragment depends on.  They are hashed into
+the key, so only fragments whose data changed are rendered again.  They
+should have stable :func:`repr` such as strings, numbers and dates.
+"""
+import hashlib
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+from cache import MemoryCache
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension adds ``{% cache key, ttl, *vary %}`` blocks stored in
+    ``fragment_cache`` of the environment.  Blocks render uncached while
+    it is :const:`None`.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_cache', [nodes.List(args)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _cache(self, args, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        key = fragment_key(args[0], args[2:])
+        fragment = cache.get(key)
+        if fragment is None:
+            fragment = caller()
+            cache.set(key, fragment, args[1] if len(args) > 1 else None)
+        return fragment
+
+
+def fragment_key(key, vary=()):
+    """Returns key of a fragment in the cache.  Fragments of `key` share its
+    prefix, so ``cache.delete_prefix(fragment_key(key))`` drops them all.
+    """
+    key = u'fragment:%s|' % key
+    if vary:
+        key += hashlib.sha1(repr(tuple(vary))).hexdigest()
+    return key
+
+
+def default_cache():
+    """Returns a new :class:`~cache.MemoryCache` of 1024 fragments.
+    """
+    return MemoryCache(maxsize=1024, max_bytes=16 * 1024 * 1024)
+
+
+def install(env, cache):
+    """Adds :class:`FragmentCacheExtension` to `env` with `cache`, a
+    backend like :class:`~cache.MemoryCache`.
+    """
+    env.add_extension(FragmentCacheExtension)
+    env.fragment_cache = cache
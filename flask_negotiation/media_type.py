@@ -3,66 +3,151 @@
 
 HTTP media type
 """
+import re
+
+from flask import current_app
+from werkzeug.datastructures import Accept
+from werkzeug.exceptions import BadRequest
+
+from cache import LRUCache
+
+
+#: Quoted string, run of plain characters or a separator.
+_token_re = re.compile(r'"(?:[^"\\]|\\.)*"?|[^",;]+|[,;]')
+_escape_re = re.compile(r'\\(.)')
 
 
 def parse_header(s):
     """Parses parameter header
     """
+    key, items = _parse_header_items(s)
+    return key, dict(items)
+
+
+def _parse_header_items(s):
     params = _parse_header_params(';'+s)
     key = params.pop(0).lower()
-    pdict = {}
+    items = []
     for param in params:
         i = param.find('=')
         if i >= 0:
             name = param[:i].strip().lower()
             value = param[i+1:].strip()
             if len(value) >= 2 and value[0] == value[-1] == '"':
-                value = value[1:-1]
-                value = value.replace(r'\\', '\\').replace(r'\"', '"')
-            pdict[name] = value
-    return key, pdict
+                value = _escape_re.sub(r'\1', value[1:-1])
+            items.append((name, value))
+    return key, items
 
 
 def _parse_header_params(s):
-    li = []
-    while s[:1] == ';':
-        s = s[1:]
-        end = s.find(';')
-        while end > 0 and s.count('"', 0, end) % 2:
-            # For quote
-            end = s.find(';', end+1)
-        end = end if end >= 0 else len(s)
-        li.append(s[:end].strip())
-        s = s[end:]
-    return li
+    if s[:1] != ';':
+        return []
+    return [x.strip() for x in _split_header(s[1:], ';')]
+
+
+def _split_header(s, separator, limit=None):
+    """Splits `s` by `separator` outside of quoted strings in a single pass.
+
+    :raises ValueError: when there are more than `limit` parts.
+    """
+    parts = []
+    start = 0
+    for match in _token_re.finditer(s):
+        if match.group() == separator:
+            parts.append(s[start:match.start()])
+            start = match.end()
+            if limit is not None and len(parts) >= limit:
+                raise ValueError('too many parts in header')
+    parts.append(s[start:])
+    return parts
 
 
 class MediaType(object):
     """Abstracted media type class.
+
+    Media types are immutable and interned, so ``MediaType(raw)`` returns
+    the same instance for the same `raw` string while it stays in
+    :attr:`instances`.  They can be used as dictionary keys, and compare
+    and hash equal to their ``type/subtype`` string.
     """
-    def __init__(self, raw):
-        raw = raw or ''
-        self.raw = raw
-        self.media_type, self.params = parse_header(raw)
-        self.main_type, sep, self.sub_type = self.media_type.partition('/')
+    __slots__ = ('raw', 'media_type', 'main_type', 'sub_type',
+                 'param_items', 'quality')
+
+    #: Interned media types by class and raw string.
+    instances = LRUCache(maxsize=1024)
+
+    def __new__(cls, raw):
+        return cls.instances.get_or_create((cls, raw or ''), cls._create)
+
+    @classmethod
+    def parse(cls, raw):
+        """Parses `raw` to a media type that is not interned, for one-off
+        values such as `Content-Type` of requests.
+
+        :raises ValueError: when the quality is malformed.
+        """
+        return cls._create((cls, raw or ''))
+
+    @staticmethod
+    def _create(key):
+        cls, raw = key
+        self = object.__new__(cls)
+        media_type, items = _parse_header_items(raw)
+        # Later parameters override earlier ones like :func:`parse_header`
+        names = set()
+        unique = []
+        for k, v in reversed(items):
+            if k not in names:
+                names.add(k)
+                unique.append((k, v))
+        items = tuple(reversed(unique))
+        main_type, sep, sub_type = media_type.partition('/')
+        setattr_ = super(MediaType, self).__setattr__
+        setattr_('raw', raw)
+        setattr_('media_type', media_type)
+        setattr_('main_type', main_type)
+        setattr_('sub_type', sub_type)
+        setattr_('param_items', items)
+        setattr_('quality', _quality(items))
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError('media type is immutable')
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return type(self), (self.raw, )
+
+    @property
+    def params(self):
+        """Parameters as a new :class:`dict`.
+        """
+        return dict(self.param_items)
+
+    def get_param(self, name, default=None):
+        """Returns value of parameter `name`.
+        """
+        for k, v in self.param_items:
+            if k == name:
+                return v
+        return default
 
     def __contains__(self, other):
-        for k, v in self.params.iteritems():
-            if k != 'q' and other.params.get(k, None) != v:
-                return False
-        if self.main_type == '*' and self.sub_type == '*':
-            return True
-        if self.sub_type == '*' and self.main_type == other.main_type:
-            return True
-        if self.main_type == '*' and self.sub_type == other.sub_type:
-            return True
-        return self == other
+        return _contains(self, other)
 
     def __eq__(self, other):
+        # Parameters are ignored, so a string equals only ``type/subtype``
+        # to agree with :meth:`__hash__`
         if isinstance(other, basestring):
-            return unicode(self) == other
-        return (self.main_type == other.main_type and
-                self.sub_type == other.sub_type)
+            return self.media_type == other
+        return self.media_type == other.media_type
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.media_type)
 
     def __repr__(self):
         return '<media type:' + str(self) + '>'
@@ -72,81 +157,472 @@ class MediaType(object):
 
     def __unicode__(self):
         return u'; '.join([u'%s/%s' % (self.main_type, self.sub_type)] +
-                          [u'%s=%s' % (k, v)
-                           for k, v in self.params.iteritems()])
+                          [u'%s=%s' % (k, v) for k, v in self.param_items])
 
     def __cmp__(self, other):
-        return cmp(float(self.quality),
-                   float(other.quality))
+        return cmp(self.quality, other.quality)
 
-    @property
-    def quality(self):
-        q = self.params.get('q', None)
-        if q is None:
-            return 1.0
-        return float(q)
 
+def _quality(items):
+    for k, v in items:
+        if k == 'q':
+            return float(v)
+    return 1.0
 
-def acceptable_media_types(request):
-    """Extract acceptable media types from request
+
+def _contains(media_type, other):
+    for k, v in media_type.param_items:
+        if k != 'q' and other.get_param(k) != v:
+            return False
+    if media_type.main_type == '*' and media_type.sub_type == '*':
+        return True
+    if media_type.sub_type == '*' and \
+            media_type.main_type == other.main_type:
+        return True
+    if media_type.main_type == '*' and media_type.sub_type == other.sub_type:
+        return True
+    return media_type == other
+
+
+try:
+    import _speedups
+except ImportError:
+    _speedups = None
+
+#: Pure Python implementation of the parsing and matching core.
+_python_core = {
+    '_split_header': _split_header,
+    '_parse_header_items': _parse_header_items,
+    '_quality': _quality,
+    '_contains': _contains,
+}
+
+#: :const:`True` while the compiled :mod:`_speedups` core is in use.
+speedups = False
+
+
+def use_speedups(enabled=True):
+    """Switches the parsing and matching core between the compiled
+    :mod:`_speedups` extension and pure Python.  The extension is used
+    whenever it is built, so this is mostly for testing and debugging.
+
+    Already parsed media types and headers stay cached; clear
+    :attr:`MediaType.instances` and :data:`accept_cache` to parse them
+    again.
+
+    :raises ImportError: when enabling an extension that is not built.
     """
-    if 'accept' in request.headers:
-        li = [x.strip() for x in request.headers['accept'].split(',')]
-    else:
+    global speedups
+    if enabled and _speedups is None:
+        raise ImportError('flask_negotiation._speedups is not built')
+    core = _python_core
+    if enabled:
+        core = dict((name, getattr(_speedups, name.lstrip('_')))
+                    for name in _python_core)
+    globals().update(core)
+    speedups = bool(enabled)
+
+
+use_speedups(_speedups is not None)
+
+
+#: Process-wide cache of parsed `Accept` headers.
+accept_cache = LRUCache(maxsize=128)
+
+
+def parse_accept(value, max_entries=None):
+    """Parses `Accept` header value to media types sorted by quality.
+    :const:`None` means the header is missing.
+
+    :param max_entries: maximum number of media types.
+    :returns: immutable :class:`tuple` of :class:`MediaType`
+    :raises ValueError: when the header is malformed or too large.
+    """
+    if value is None:
         li = ['*/*']
+    else:
+        li = [x.strip() for x in _split_header(value, ',', max_entries)]
     li = li or ['*/*']
-    return sorted(map(MediaType, li), reverse=True)
+    return tuple(sorted(map(MediaType, li), reverse=True))
+
+
+def _parse_accept_key(key):
+    """Parses a `(value, max_entries)` key of accept caches.
+    """
+    return parse_accept(*key)
+
+
+def _app_accept_cache():
+    """Returns the accept cache configured for current application.
+
+    ``NEGOTIATION_ACCEPT_CACHE`` may be :const:`True` (default) to use
+    :data:`accept_cache`, :const:`False` to disable caching, or an
+    application specific :class:`~cache.LRUCache`.
+    """
+    cache = current_app.config.get('NEGOTIATION_ACCEPT_CACHE', True)
+    if cache is True:
+        return accept_cache
+    if cache is False:
+        return None
+    return cache
+
+
+def acceptable_media_types(request, cache=None):
+    """Extract acceptable media types from request
+
+    Headers longer than ``NEGOTIATION_ACCEPT_MAX_LENGTH`` (default 4096)
+    characters or with more than ``NEGOTIATION_ACCEPT_MAX_ENTRIES`` (default
+    64) media types are rejected with HTTP 400 (Bad Request), as are
+    malformed quality values.
+
+    Parsed media types are kept in the WSGI environ of `request`, so the
+    header is parsed at most once per request however many times it is
+    negotiated.  `request` may also be Werkzeug's
+    :class:`~werkzeug.datastructures.MIMEAccept` such as
+    ``request.accept_mimetypes`` to reuse what Werkzeug already parsed.
+
+    :param cache: :class:`~cache.LRUCache` of parsed headers.  :const:`None`
+        to use the cache configured for current application.
+    """
+    if isinstance(request, Accept):
+        return from_accept(request)
+    return _acceptables(request, 'Accept', cache)
+
+
+def acceptable_encodings(request, cache=None):
+    """Extract acceptable content codings from `Accept-Encoding` of request
+    like :func:`acceptable_media_types`.  Codings are :class:`MediaType`
+    without subtype.  Missing header gives an empty tuple.
+    """
+    if 'accept-encoding' not in request.headers:
+        return ()
+    return _acceptables(request, 'Accept-Encoding', cache)
+
+
+def from_accept(accept):
+    """Converts Werkzeug's :class:`~werkzeug.datastructures.Accept` to media
+    types sorted by quality like :func:`parse_accept`.
+    """
+    media_types = []
+    for value, quality in accept:
+        if quality != 1:
+            value = '%s;q=%s' % (value, quality)
+        media_types.append(MediaType(value))
+    return tuple(sorted(media_types or [MediaType('*/*')], reverse=True))
+
+
+def _acceptables(request, name, cache):
+    environ = request.environ
+    key = 'flask_negotiation.' + name.lower()
+    try:
+        return environ[key]
+    except KeyError:
+        pass
+    environ[key] = acceptables = _parse_acceptables(request, name, cache)
+    return acceptables
+
+
+def _parse_acceptables(request, name, cache):
+    value = request.headers.get(name, None)
+    config = current_app.config
+    max_length = config.get('NEGOTIATION_ACCEPT_MAX_LENGTH', 4096)
+    max_entries = config.get('NEGOTIATION_ACCEPT_MAX_ENTRIES', 64)
+    if value is not None and max_length and len(value) > max_length:
+        raise BadRequest('%s header is too long.' % name)
+
+    max_entries = max_entries or None
+    if cache is None:
+        cache = _app_accept_cache()
+    try:
+        if cache is None:
+            return parse_accept(value, max_entries)
+        # Applications may limit entries differently
+        return cache.get_or_create((value, max_entries), _parse_accept_key)
+    except ValueError:
+        raise BadRequest('Malformed %s header.' % name)
+
+
+def choose_encoding(acceptables, encodings):
+    """Choose best content coding.
+    :param acceptables: list of content coding acceptable
+    :param encodings: list of content coding supported in order of
+        preference
+
+    :returns: best content coding or :const:`None` for identity.
+    """
+    qualities = {}
+    for acceptable in acceptables:
+        qualities.setdefault(acceptable.media_type, acceptable.quality)
+    default = qualities.get('*', 0.0)
+    identity = qualities.get('identity', qualities.get('*', 1.0))
+    choosen, quality = None, 0.0
+    for encoding in encodings:
+        if qualities.get(encoding, default) > quality:
+            choosen, quality = encoding, qualities.get(encoding, default)
+    if quality < identity:
+        return None
+    return choosen
 
 
 def best_renderer(renderers, media_types):
     """Choose best renderer and media type
+
+    Higher quality media types win, then earlier media types, then earlier
+    renderers.
+
+    :param renderers: list of renderers or :class:`RendererIndex` of them
     """
-    choosen_items = []
+    if isinstance(renderers, RendererIndex):
+        return renderers.best(media_types)
+    choosen = None, None
+    quality = None
     for media_type in media_types:
+        if quality is not None and media_type.quality <= quality:
+            continue
         for renderer in renderers:
-            choosen = renderer.choose_media_type(media_type)
-            if not choosen is None:
-                choosen_items.append((renderer, choosen, media_type))
-    if not choosen_items:
-        return None, None
-
-    def cmp_types(first, second):
-        renderer1, choosen1, media_type1 = first
-        renderer2, choosen2, media_type2 = second
-        if media_type1 == media_type2:
-            return cmp(renderers.index(renderer2), renderers.index(renderer1))
-        if media_type1.quality == media_type2.quality:
-            return cmp(media_types.index(media_type2),
-                       media_types.index(media_type1))
-        return cmp(media_type1.quality, media_type2.quality)
-
-    return tuple(sorted(choosen_items, cmp=cmp_types)[-1][:2])
+            choosen_type = renderer.choose_media_type(media_type)
+            if not choosen_type is None:
+                choosen = renderer, choosen_type
+                quality = media_type.quality
+                break
+    return choosen
 
 
 def choose_media_type(acceptables, media_types):
     """Choose best acceptable media type.
-    :param acceptables: list of media type acceptable
-    :param media_types: list of media type supported
+    :param acceptables: list of media type acceptable or Werkzeug's
+        :class:`~werkzeug.datastructures.MIMEAccept`
+    :param media_types: list of media type supported or
+        :class:`MediaTypeIndex` of them
 
     :returns: best acceptable media type or :const:`None` if cannot handle.
     """
-    choosen = []
+    if isinstance(acceptables, Accept):
+        acceptables = from_accept(acceptables)
+    if isinstance(media_types, MediaTypeIndex):
+        return media_types.choose(acceptables)
+    choosen = None
     for acceptable in acceptables:
+        if choosen is not None and acceptable.quality <= choosen.quality:
+            continue
         for media_type in media_types:
             if acceptable in media_type:
-                choosen.append((acceptable, media_type))
-    if not choosen:
-        return None
+                choosen = acceptable
+                break
+    return choosen
 
-    def cmp_types(first, second):
-        acceptable1, media_type1 = first
-        acceptable2, media_type2 = second
-        if acceptable.quality == acceptable2.quality:
-            return cmp(acceptables.index(acceptable2),
-                       acceptables.index(acceptable1))
-        return cmp(acceptable.quality, acceptable.quality)
 
-    return sorted(choosen, cmp=cmp_types)[-1][0]
+class MediaTypeIndex(object):
+    """Lookup table of supported media types.
+
+    Supported types are bucketed by exact ``type/subtype``, ``type/*``,
+    ``*/subtype`` and ``*/*``, so matching an acceptable media type costs a
+    few dictionary lookups instead of a scan of every supported type.
+    """
+    def __init__(self, media_types):
+        super(MediaTypeIndex, self).__init__()
+        self.media_types = tuple(media_types)
+        self.exact = {}
+        self.main_types = {}
+        self.sub_types = {}
+        self.wildcards = []
+        for position, media_type in enumerate(self.media_types):
+            constraints = tuple((k, v) for k, v in media_type.param_items
+                                if k != 'q')
+            entry = (position, media_type, constraints)
+            main_type, sub_type = media_type.main_type, media_type.sub_type
+            if main_type == '*' and sub_type == '*':
+                self.wildcards.append(entry)
+            elif sub_type == '*':
+                self.main_types.setdefault(main_type, []).append(entry)
+            elif main_type == '*':
+                self.sub_types.setdefault(sub_type, []).append(entry)
+            else:
+                self.exact.setdefault((main_type, sub_type), []).append(entry)
+
+    def _matching(self, acceptable):
+        get_param = acceptable.get_param
+        for bucket in (self.exact.get((acceptable.main_type,
+                                       acceptable.sub_type), ()),
+                       self.main_types.get(acceptable.main_type, ()),
+                       self.sub_types.get(acceptable.sub_type, ()),
+                       self.wildcards):
+            for position, media_type, constraints in bucket:
+                if all(get_param(k) == v for k, v in constraints):
+                    yield position, media_type
+
+    def match(self, acceptable):
+        """Returns supported media types containing `acceptable` in the
+        order they were given.
+        """
+        return [self.media_types[x] for x in self.positions(acceptable)]
+
+    def positions(self, acceptable):
+        """Returns positions of supported media types containing
+        `acceptable` in the order they were given.
+        """
+        return sorted(position for position, _ in self._matching(acceptable))
+
+    def accepts(self, acceptable):
+        """Determines that any supported media type contains `acceptable`.
+        """
+        for _ in self._matching(acceptable):
+            return True
+        return False
+
+    def choose(self, acceptables):
+        """Chooses best acceptable media type like :func:`choose_media_type`.
+        """
+        choosen = None
+        for acceptable in acceptables:
+            if choosen is not None and acceptable.quality <= choosen.quality:
+                continue
+            if self.accepts(acceptable):
+                choosen = acceptable
+        return choosen
+
+
+class RendererIndex(object):
+    """Lookup table of media types of renderers.
+
+    Media types containing an acceptable media type are found through a
+    :class:`MediaTypeIndex`, and media types contained by a wildcard
+    acceptable media type through dictionaries by type, main type and
+    subtype, so :func:`best_renderer` costs a few dictionary lookups per
+    acceptable media type.
+    """
+    def __init__(self, renderers):
+        super(RendererIndex, self).__init__()
+        self.renderers = tuple(renderers)
+        self.entries = [(renderer, media_type)
+                        for renderer in self.renderers
+                        for media_type in renderer.media_types]
+        self.types = MediaTypeIndex(x for _, x in self.entries)
+        self.exact = {}
+        self.main_types = {}
+        self.sub_types = {}
+        for position, (_, media_type) in enumerate(self.entries):
+            main_type, sub_type = media_type.main_type, media_type.sub_type
+            self.exact.setdefault((main_type, sub_type), []).append(position)
+            self.main_types.setdefault(main_type, []).append(position)
+            self.sub_types.setdefault(sub_type, []).append(position)
+
+    def _contained(self, acceptable):
+        main_type, sub_type = acceptable.main_type, acceptable.sub_type
+        if main_type == '*' and sub_type == '*':
+            positions = xrange(len(self.entries))
+        elif sub_type == '*':
+            positions = self.main_types.get(main_type, ())
+        elif main_type == '*':
+            positions = self.sub_types.get(sub_type, ())
+        else:
+            positions = self.exact.get((main_type, sub_type), ())
+        constraints = [(k, v) for k, v in acceptable.param_items if k != 'q']
+        for position in positions:
+            get_param = self.entries[position][1].get_param
+            if all(get_param(k) == v for k, v in constraints):
+                yield position
+
+    def choose(self, acceptable):
+        """Chooses renderer and media type for an acceptable media type, the
+        first matching media type of the first matching renderer.
+
+        :returns: pair of renderer and media type or :const:`None`
+        """
+        positions = [x for x, _ in self.types._matching(acceptable)]
+        positions.extend(self._contained(acceptable))
+        if not positions:
+            return None
+        return self.entries[min(positions)]
+
+    def best(self, media_types):
+        """Chooses best renderer and media type like :func:`best_renderer`.
+        """
+        choosen = None, None
+        quality = None
+        for media_type in media_types:
+            if quality is not None and media_type.quality <= quality:
+                continue
+            entry = self.choose(media_type)
+            if entry is not None:
+                choosen = entry
+                quality = media_type.quality
+        return choosen
+
+
+def best_renderers(accepts, renderers, cache=accept_cache, max_entries=None):
+    """Chooses renderer and media type for many `Accept` header values at
+    once, like :func:`best_renderer` does for one.  Identical headers are
+    negotiated once, and choices per acceptable media type are shared among
+    headers.
+
+    :param accepts: iterable of `Accept` header values.  :const:`None`
+        means the header is missing.
+    :param renderers: list of renderers or :class:`RendererIndex` of them
+    :param cache: :class:`~cache.LRUCache` of parsed headers.  :const:`None`
+        not to cache.  Headers are cached with `max_entries`, so those
+        parsed under other limits are not reused
+    :param max_entries: maximum number of media types per header.
+    :returns: list of pairs of renderer and media type in order of
+        `accepts`, ``(None, None)`` where nothing is acceptable.
+    :raises ValueError: when a header is malformed or too large.
+    """
+    if not isinstance(renderers, RendererIndex):
+        renderers = RendererIndex(renderers)
+    return _negotiate_many(accepts, renderers.choose, (None, None), cache,
+                           max_entries)
+
+
+def choose_media_types(accepts, media_types, cache=accept_cache,
+                       max_entries=None):
+    """Chooses best acceptable media type for many `Accept` header values
+    at once, like :func:`choose_media_type` does for one.  Parameters are
+    the same as :func:`best_renderers`.
+
+    :param media_types: list of media type supported or
+        :class:`MediaTypeIndex` of them
+    :returns: list of media types in order of `accepts`, :const:`None`
+        where nothing is acceptable.
+    """
+    if not isinstance(media_types, MediaTypeIndex):
+        media_types = MediaTypeIndex(media_types)
+    accepts_ = media_types.accepts
+
+    def choose(acceptable):
+        return acceptable if accepts_(acceptable) else None
+    return _negotiate_many(accepts, choose, None, cache, max_entries)
+
+
+def _negotiate_many(accepts, choose, default, cache, max_entries):
+    """Negotiates each header of `accepts` with `choose`, which returns
+    choice for an acceptable media type or :const:`None`.  Choices of
+    higher quality win, then earlier ones.
+    """
+    missing = object()
+    choices = {}
+    decisions = {}
+    results = []
+    for value in accepts:
+        decision = decisions.get(value, missing)
+        if decision is missing:
+            if cache is None:
+                acceptables = parse_accept(value, max_entries)
+            else:
+                acceptables = cache.get_or_create((value, max_entries),
+                                                  _parse_accept_key)
+            decision, quality = default, None
+            for acceptable in acceptables:
+                if quality is not None and acceptable.quality <= quality:
+                    continue
+                # Parameters matter but `==` of media types ignores them
+                choice = choices.get(acceptable.raw, missing)
+                if choice is missing:
+                    choice = choices[acceptable.raw] = choose(acceptable)
+                if choice is not None:
+                    decision, quality = choice, acceptable.quality
+            decisions[value] = decision
+        results.append(decision)
+    return results
 
 
 def can_accept(acceptables, media_types):
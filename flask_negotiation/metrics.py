@@ -0,0 +1,145 @@
+""":mod:`metrics`
+=================
+
+Collects negotiation timings and counters from :mod:`signals` and exposes
+them in Prometheus text format.
+"""
+import threading
+
+import signals
+
+#: Default upper bounds of duration histogram buckets in seconds.
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                    0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+#: Default upper bounds of response size histogram buckets in bytes.
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram(object):
+    """Cumulative histogram per label set.
+    """
+    def __init__(self, buckets):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def lines(self, name, label_names):
+        for labels, (counts, total, count) in sorted(self.series.items()):
+            pairs = zip(label_names, labels)
+            for bound, bucket in zip(self.buckets, counts):
+                yield '%s_bucket%s %d' % (
+                    name, _labels(pairs + [('le', repr(bound))]), bucket)
+            yield '%s_bucket%s %d' % (
+                name, _labels(pairs + [('le', '+Inf')]), count)
+            yield '%s_sum%s %r' % (name, _labels(pairs), total)
+            yield '%s_count%s %d' % (name, _labels(pairs), count)
+
+
+class PrometheusMetrics(object):
+    """Keeps histograms of negotiation and render durations and response
+    sizes per renderer and media type, and counts of not acceptable
+    requests::
+
+        metrics = PrometheusMetrics()
+
+        @app.route('/metrics')
+        def export_metrics():
+            return Response(metrics.exposition(),
+                            content_type=metrics.content_type)
+
+    It receives signals while it is connected.  Nothing is measured while
+    no receiver is connected.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, prefix='flask_negotiation',
+                 duration_buckets=DURATION_BUCKETS, size_buckets=SIZE_BUCKETS,
+                 connect=True):
+        super(PrometheusMetrics, self).__init__()
+        self.prefix = prefix
+        self.negotiate = Histogram(duration_buckets)
+        self.render = Histogram(duration_buckets)
+        self.view = Histogram(duration_buckets)
+        self.size = Histogram(size_buckets)
+        self.not_acceptable = 0
+        self._lock = threading.Lock()
+        if connect:
+            self.connect()
+
+    def connect(self):
+        signals.rendered.connect(self.on_rendered, weak=False)
+        signals.provided.connect(self.on_provided, weak=False)
+        signals.not_acceptable.connect(self.on_not_acceptable, weak=False)
+
+    def disconnect(self):
+        signals.rendered.disconnect(self.on_rendered)
+        signals.provided.disconnect(self.on_provided)
+        signals.not_acceptable.disconnect(self.on_not_acceptable)
+
+    def on_rendered(self, sender, renderer, media_type, response, size,
+                    timings):
+        labels = (_renderer_name(renderer), media_type.media_type)
+        with self._lock:
+            self.negotiate.observe(labels, timings['negotiate'])
+            if 'render' in timings:
+                self.render.observe(labels, timings['render'])
+            if size is not None:
+                self.size.observe(labels, size)
+
+    def on_provided(self, sender, media_type, response, timings):
+        labels = (sender.__name__, media_type.media_type)
+        with self._lock:
+            self.view.observe(labels, timings['view'])
+
+    def on_not_acceptable(self, sender, accept):
+        with self._lock:
+            self.not_acceptable += 1
+
+    def exposition(self):
+        """Returns metrics in Prometheus text exposition format.
+        """
+        prefix = self.prefix
+        metrics = [
+            (self.negotiate, 'negotiate_seconds', ('renderer', 'media_type'),
+             'Seconds spent choosing renderer and media type.'),
+            (self.render, 'render_seconds', ('renderer', 'media_type'),
+             'Seconds spent rendering response bodies.'),
+            (self.size, 'response_bytes', ('renderer', 'media_type'),
+             'Sizes of rendered response bodies.'),
+            (self.view, 'view_seconds', ('view', 'media_type'),
+             'Seconds spent in views decorated by provides.'),
+        ]
+        lines = []
+        with self._lock:
+            for histogram, name, label_names, help_ in metrics:
+                name = '%s_%s' % (prefix, name)
+                lines.append('# HELP %s %s' % (name, help_))
+                lines.append('# TYPE %s histogram' % name)
+                lines.extend(histogram.lines(name, label_names))
+            name = '%s_not_acceptable_total' % prefix
+            lines.append('# HELP %s Requests answered with 406.' % name)
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, self.not_acceptable))
+        return '\n'.join(lines) + '\n'
+
+
+def _renderer_name(renderer):
+    return getattr(renderer, '__name__', type(renderer).__name__)
+
+
+def _labels(pairs):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs)
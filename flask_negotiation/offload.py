@@ -0,0 +1,153 @@
+""":mod:`offload`
+=================
+
+Rendering large payloads off the request thread
+"""
+import threading
+import time
+
+from flask import copy_current_request_context
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import TimeoutError as FutureTimeoutError
+except ImportError:
+    ProcessPoolExecutor = FutureTimeoutError = None
+
+
+def estimate_size(data):
+    """Default size estimator, length of `data` or ``0`` if it has none.
+    """
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+
+def _render(renderer, data, template, ctx):
+    started = time.time()
+    return started, renderer.render(data, template, ctx)
+
+
+class OffloadPolicy(object):
+    """Renders payloads estimated larger than `threshold` on `executor`.
+
+    With a :class:`~concurrent.futures.ProcessPoolExecutor` the renderer
+    and data are pickled and the renderer cannot use the request context,
+    so it suits renderers like :class:`~renderers.JSONRenderer`.  With a
+    thread pool the render runs with a copy of current request context.
+
+    If rendering takes longer than `timeout` seconds or the executor fails,
+    `data` is rendered inline instead when `fallback` is set.  Renders
+    already running on a thread of `executor` are never offloaded again, so
+    they cannot wait for a worker of the pool they occupy.
+    """
+    def __init__(self, executor, threshold=10000, estimators=None,
+                 timeout=None, fallback=True):
+        """:param executor: :class:`concurrent.futures.Executor` to render on.
+        :param threshold: estimated size above which rendering is offloaded.
+        :param estimators: size estimators by renderer or renderer class.
+            :func:`estimate_size` is used for others.
+        :param timeout: seconds to wait for offloaded rendering.
+        :param fallback: renders inline on timeout or failure.
+        """
+        super(OffloadPolicy, self).__init__()
+        self.executor = executor
+        self.threshold = threshold
+        self.estimators = estimators or {}
+        self.timeout = timeout
+        self.fallback = fallback
+        self.process = (ProcessPoolExecutor is not None and
+                        isinstance(executor, ProcessPoolExecutor))
+        self.submitted = self.completed = self.pending = 0
+        self.timeouts = self.fallbacks = 0
+        self.wait_time = self.render_time = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def estimate(self, renderer, data):
+        """Estimates size of `data` rendered by `renderer`.
+        """
+        estimator = (self.estimators.get(renderer) or
+                     self.estimators.get(type(renderer)) or estimate_size)
+        return estimator(data)
+
+    def should_offload(self, renderer, data):
+        """Determines that `renderer` should render `data` on executor.
+        """
+        if self.on_executor():
+            return False
+        return self.estimate(renderer, data) > self.threshold
+
+    def on_executor(self):
+        """Determines that current thread is a worker of executor.
+        """
+        if getattr(self._local, 'offloaded', False):
+            return True
+        # Thread pools keep their workers in ``_threads``
+        return threading.current_thread() in \
+            getattr(self.executor, '_threads', ())
+
+    def render(self, renderer, data, template=None, ctx=None):
+        """Renders `data` on executor and waits for the result.
+        """
+        render = _render if self.process else \
+            copy_current_request_context(self._render_on_thread)
+        submitted = time.time()
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+        try:
+            try:
+                future = self.executor.submit(render, renderer, data,
+                                              template, ctx)
+                started, body = future.result(self.timeout)
+            finally:
+                with self._lock:
+                    self.pending -= 1
+        except Exception as e:
+            timeout = _is_timeout(e)
+            with self._lock:
+                if timeout:
+                    self.timeouts += 1
+                if self.fallback:
+                    self.fallbacks += 1
+            if timeout:
+                future.cancel()
+            if not self.fallback:
+                raise
+            return renderer.render(data, template, ctx)
+        finished = time.time()
+        with self._lock:
+            self.completed += 1
+            self.wait_time += max(started - submitted, 0.0)
+            self.render_time += finished - started
+        return body
+
+    def _render_on_thread(self, renderer, data, template, ctx):
+        self._local.offloaded = True
+        try:
+            return _render(renderer, data, template, ctx)
+        finally:
+            self._local.offloaded = False
+
+    @property
+    def stats(self):
+        """Dictionary of queue depth, counts and mean latencies in seconds.
+        """
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'pending': self.pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'fallbacks': self.fallbacks,
+                'mean_wait': self.wait_time / completed,
+                'mean_render': self.render_time / completed,
+            }
+
+
+def _is_timeout(e):
+    return FutureTimeoutError is not None and \
+        isinstance(e, FutureTimeoutError)
@@ -0,0 +1,207 @@
+""":mod:`parsers`
+=================
+
+Parsers of request bodies, the counterpart of renderers
+"""
+import codecs
+import json
+from abc import ABCMeta, abstractmethod
+
+from werkzeug.datastructures import CombinedMultiDict
+from werkzeug.exceptions import (BadRequest, RequestEntityTooLarge,
+                                 UnsupportedMediaType)
+from werkzeug.formparser import FormDataParser
+
+from media_type import MediaType
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+def iter_body(stream, max_length=None, chunk_size=65536):
+    """Reads `stream` in chunks of `chunk_size` bytes.
+
+    :raises RequestEntityTooLarge: when it is longer than `max_length`.
+    """
+    length = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        length += len(chunk)
+        if max_length is not None and length > max_length:
+            raise RequestEntityTooLarge()
+        yield chunk
+
+
+def read_body(stream, max_length=None):
+    """Reads whole `stream` like :func:`iter_body`.
+    """
+    return b''.join(iter_body(stream, max_length))
+
+
+class Parser(object):
+    """Base parser class.
+    """
+    __metaclass__ = ABCMeta
+
+    __media_types__ = ()
+    """A collection of supporting media-type :class:`string`s, subclasses must
+    redefine this value.
+    """
+
+    @property
+    def media_types(self):
+        """Collections of abstracted media-types.
+        """
+        return tuple(MediaType(x) for x in self.__media_types__)
+
+    def can_parse(self, media_type):
+        """Determines that parser can parse `media_type`.
+        """
+        return any(media_type in x for x in self.media_types)
+
+    @abstractmethod
+    def parse(self, stream, media_type, content_length=None,
+              max_length=None):
+        """Parses request body from `stream` of `media_type`.
+
+        You must implement it
+        """
+        pass
+
+    # Parsers that can decode incrementally define ``parse_iter`` with the
+    # signature of :meth:`parse` returning an iterable of decoded objects.
+
+
+class JSONParser(Parser):
+    """Parses JSON.  It decodes newline delimited JSON incrementally.
+    """
+    __media_types__ = ('application/json', 'application/x-ndjson')
+
+    def parse(self, stream, media_type, content_length=None,
+              max_length=None):
+        charset = _charset(media_type)
+        body = read_body(stream, max_length)
+        try:
+            return json.loads(body.decode(charset))
+        except ValueError:
+            raise BadRequest('Malformed JSON body.')
+
+    def parse_iter(self, stream, media_type, content_length=None,
+                   max_length=None):
+        """Decodes a JSON value per line.
+        """
+        charset = _charset(media_type)
+        buf = b''
+        for chunk in iter_body(stream, max_length):
+            lines = (buf + chunk).split(b'\n')
+            buf = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield self._loads(line, charset)
+        if buf.strip():
+            yield self._loads(buf, charset)
+
+    def _loads(self, line, charset):
+        try:
+            return json.loads(line.decode(charset))
+        except ValueError:
+            raise BadRequest('Malformed JSON body.')
+
+
+def _charset(media_type):
+    """Returns `charset` parameter of `media_type`, UTF-8 by default.
+
+    :raises UnsupportedMediaType: when the charset is unknown or not a text
+        encoding.
+    """
+    charset = media_type.get_param('charset', 'utf-8')
+    try:
+        codec = codecs.lookup(charset)
+    except LookupError:
+        codec = None
+    # Byte transforms like zlib and hex are codecs too, which the standard
+    # library marks in the same way to keep them from decoding text
+    if codec is None or not getattr(codec, '_is_text_encoding', True):
+        raise UnsupportedMediaType('Unsupported charset %r.' % (charset, ))
+    return charset
+
+
+class FormParser(Parser):
+    """Parses URL encoded and multipart forms with werkzeug.
+    """
+    __media_types__ = ('application/x-www-form-urlencoded',
+                       'multipart/form-data')
+
+    def parse(self, stream, media_type, content_length=None,
+              max_length=None):
+        parser = FormDataParser(max_content_length=max_length)
+        stream, form, files = parser.parse(stream, media_type.media_type,
+                                           content_length,
+                                           media_type.params)
+        if files:
+            return CombinedMultiDict([form, files])
+        return form
+
+
+class MsgPackParser(Parser):
+    """Parses MessagePack with :mod:`msgpack`.  It decodes a sequence of
+    objects incrementally.
+    """
+    __media_types__ = ('application/msgpack', 'application/x-msgpack')
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+        super(MsgPackParser, self).__init__()
+
+    def parse(self, stream, media_type, content_length=None,
+              max_length=None):
+        try:
+            return msgpack.unpackb(read_body(stream, max_length), raw=False)
+        except (ValueError, msgpack.exceptions.UnpackException):
+            raise BadRequest('Malformed MessagePack body.')
+
+    def parse_iter(self, stream, media_type, content_length=None,
+                   max_length=None):
+        """Decodes objects as their bytes arrive.
+        """
+        unpacker = msgpack.Unpacker(raw=False)
+        for chunk in iter_body(stream, max_length):
+            try:
+                unpacker.feed(chunk)
+                objs = list(unpacker)
+            except (ValueError, msgpack.exceptions.UnpackException):
+                raise BadRequest('Malformed MessagePack body.')
+            for obj in objs:
+                yield obj
+
+
+class CBORParser(Parser):
+    """Parses CBOR with :mod:`cbor2`.
+    """
+    __media_types__ = ('application/cbor', )
+
+    def __init__(self):
+        if cbor2 is None:
+            raise ImportError('cbor2 is not installed')
+        super(CBORParser, self).__init__()
+
+    def parse(self, stream, media_type, content_length=None,
+              max_length=None):
+        try:
+            return cbor2.loads(read_body(stream, max_length))
+        except (ValueError, cbor2.CBORDecodeError):
+            raise BadRequest('Malformed CBOR body.')
+
+# default parsers
+json_parser = JSONParser()
+form_parser = FormParser()
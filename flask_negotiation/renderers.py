@@ -3,12 +3,48 @@
 
 Renderers
 """
+import collections
+import csv
+import datetime
+import decimal
 import json
+import threading
 from abc import ABCMeta, abstractmethod
-from flask import render_template
+from flask import current_app, stream_with_context, template_rendered
 from functools import wraps
+import fragments
 from media_type import MediaType
 
+try:
+    import dataclasses
+except ImportError:
+    dataclasses = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    from flask import before_render_template
+except ImportError:
+    before_render_template = None
+
 
 class Renderer(object):
     """Base renderer class.
@@ -20,11 +56,21 @@ class Renderer(object):
     redefine this value.
     """
 
+    cache_control = None
+    """`Cache-Control` header value for responses rendered by this renderer,
+    or :const:`None` to leave it unset.
+    """
+
+    streaming = False
+    """Whether :class:`~flask_negotiation.Render` streams with this renderer
+    unless told otherwise.
+    """
+
     @property
     def media_types(self):
         """Collections of abstracted media-types.
         """
-        return (MediaType(x) for x in self.__media_types__)
+        return tuple(MediaType(x) for x in self.__media_types__)
 
     def can_render(self, media_type):
         """Determines that renderer can render `media_type`.
@@ -32,13 +78,13 @@ class Renderer(object):
         return not self.choose_media_type(media_type) is None
 
     def choose_media_type(self, media_type):
-        """Chooses media type that will be rendered.
+        """Chooses media type that will be rendered, the first supported
+        media type matching `media_type`.
         """
-        chosen_type = None
         for renderer_type in self.media_types:
             if media_type in renderer_type or renderer_type in media_type:
-                chosen_type = renderer_type
-        return chosen_type
+                return renderer_type
+        return None
 
     @abstractmethod
     def render(self, data, template=None, ctx=None):
@@ -48,40 +94,381 @@ class Renderer(object):
         """
         pass
 
+    # Renderers that can stream define ``render_iter`` with the signature of
+    # :meth:`render` returning an iterable of body chunks.
+
 
 class TemplateRenderer(Renderer):
     """Renders object to HTML response.
+
+    Compiled templates are cached per Jinja environment and template name
+    in :attr:`templates`, so rendering skips name resolution and loader
+    lookups.  It is a plain dictionary read without locking, and arbitrary
+    entries are dropped when it grows over `cache_size`.  With
+    `auto_reload`, cached templates are reloaded when their source changes;
+    :const:`None` follows ``auto_reload`` of the application's Jinja
+    environment, which is off unless debugging or ``TEMPLATES_AUTO_RELOAD``
+    is set.
+
+    `fragment_cache` enables ``{% cache %}`` blocks of
+    :mod:`~flask_negotiation.fragments` in templates it renders, stored in
+    the given backend.  :const:`True` uses a default
+    :class:`~cache.MemoryCache`.  The extension is added to an application
+    by :meth:`init_app`, which :class:`~flask_negotiation.Negotiation`
+    calls.
     """
     __media_types__ = ('text/html', )
 
-    def __init__(self, ext='html'):
+    def __init__(self, ext='html', chunk_size=8192, cache_size=256,
+                 auto_reload=None, fragment_cache=None):
         super(TemplateRenderer, self).__init__()
         self.ext = ext
+        self.chunk_size = chunk_size
+        self.auto_reload = auto_reload
+        if fragment_cache is True:
+            fragment_cache = fragments.default_cache()
+        self.fragment_cache = fragment_cache
+        self.cache_size = cache_size
+        self.templates = {}
+        self._lock = threading.Lock()
 
-    def render(self, data, template=None, ctx=None):
-        template = template or ''
+    def init_app(self, app):
+        """Adds ``{% cache %}`` blocks to the Jinja environment of `app`
+        unless it has a fragment cache already.
+        """
+        env = app.jinja_env
+        if self.fragment_cache is not None and \
+                getattr(env, 'fragment_cache', None) is None:
+            fragments.install(env, self.fragment_cache)
+
+    def get_template(self, template, app=None):
+        """Returns compiled template of `template` name, whose extension
+        can be omitted.
+        """
+        env = (app or current_app).jinja_env
+        key = env, template
+        compiled = self.templates.get(key)
+        if compiled is None:
+            compiled = self._load(env, template)
+        else:
+            auto_reload = self.auto_reload
+            if auto_reload is None:
+                auto_reload = env.auto_reload
+            if auto_reload and not compiled.is_up_to_date:
+                compiled = self._load(env, template, reload=True)
+        return compiled
+
+    def _load(self, env, template, reload=False):
+        name = template or ''
         ext = '.' + self.ext
-        if not template.endswith(ext):
-            template += ext
-        ctx = ctx or {
+        if not name.endswith(ext):
+            name += ext
+        if reload:
+            # The environment's own cache may hold the stale template
+            compiled = env.loader.load(env, name, env.make_globals(None))
+        else:
+            compiled = env.get_template(name)
+        with self._lock:
+            while self.templates and len(self.templates) >= self.cache_size:
+                self.templates.popitem()
+            self.templates[env, template] = compiled
+        return compiled
+
+    def warm(self, app, templates=None):
+        """Compiles and caches `templates` of `app` ahead of requests.
+        :const:`None` warms every template with the extension the loaders
+        of `app` and its registered blueprints list.
+
+        :returns: number of warmed templates.
+        """
+        env = app.jinja_env
+        ext = '.' + self.ext
+        if templates is None:
+            templates = env.list_templates(extensions=[self.ext])
+        count = 0
+        for template in templates:
+            compiled = self._load(env, template)
+            if template.endswith(ext):
+                # Views usually omit the extension
+                with self._lock:
+                    self.templates[env, template[:-len(ext)]] = compiled
+            count += 1
+        return count
+
+    def _template_and_ctx(self, data, template, ctx):
+        app = current_app._get_current_object()
+        compiled = self.get_template(template, app)
+        ctx = dict(ctx) if ctx else {
             'data': data
         }
-        return render_template(template, **ctx)
+        app.update_template_context(ctx)
+        if before_render_template is not None:
+            before_render_template.send(app, template=compiled, context=ctx)
+        return app, compiled, ctx
+
+    def render(self, data, template=None, ctx=None):
+        app, template, ctx = self._template_and_ctx(data, template, ctx)
+        rendered = template.render(ctx)
+        template_rendered.send(app, template=template, context=ctx)
+        return rendered
+
+    def render_iter(self, data, template=None, ctx=None):
+        """Renders `data` as chunks of about `chunk_size` characters.
+        """
+        app, template, ctx = self._template_and_ctx(data, template, ctx)
+        return buffered(stream_with_context(template.generate(ctx)),
+                        self.chunk_size)
+
+
+def encode_default(obj):
+    """Converts objects that JSON backends cannot encode natively.
+
+    Dates and times become ISO 8601 strings, :class:`~decimal.Decimal`
+    becomes a string to keep its precision and dataclasses become
+    dictionaries.
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if dataclasses is not None and dataclasses.is_dataclass(obj) and \
+            not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    raise TypeError('%r is not JSON serializable' % (obj, ))
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _supports_default(module):
+    """Determines that `dumps` of JSON library `module` takes a `default`
+    function, which ujson does since 5.4 and orjson since 2.0.
+    """
+    if module is None:
+        return False
+    try:
+        return module.dumps(object(), default=lambda obj: None) in \
+            ('null', b'null')
+    except Exception:
+        return False
 
 
 class JSONRenderer(Renderer):
-    """Renders object to json with JSONEncoder.
+    """Renders object to json bytes with `backend`.
+
+    `backend` is one of ``'orjson'``, ``'ujson'`` and ``'stdlib'``, or
+    :const:`None` to use the fastest one installed that supports `default`.
     """
     __media_types__ = ('application/json',)
 
-    def __init__(self, encoder=json.JSONEncoder()):
-        """:param encoder: encoder to be used with renderer.
+    backends = ('orjson', 'ujson', 'stdlib')
+
+    #: Names of backends installed with `default` support.
+    available = tuple(name for name, module in (('orjson', orjson),
+                                                ('ujson', ujson))
+                      if _supports_default(module)) + ('stdlib', )
+
+    def __init__(self, encoder=None, chunk_size=8192, backend=None,
+                 default=encode_default):
+        """:param encoder: :class:`json.JSONEncoder` to be used with renderer.
+            implies ``'stdlib'`` backend.
+        :param chunk_size: approximate size of streamed chunks.
+        :param backend: name of JSON library.
+        :param default: function converts objects the backend cannot encode.
         """
         super(JSONRenderer, self).__init__()
-        self.encoder = encoder
+        if encoder is not None:
+            backend = 'stdlib'
+        elif backend is None:
+            backend = self.available[0]
+        if backend not in self.backends:
+            raise ValueError('unknown JSON backend: %r' % (backend, ))
+        if backend not in self.available:
+            raise ImportError('%s supporting default is not installed' %
+                              (backend, ))
+        self.backend = backend
+        self.default = default
+        self.encoder = encoder or json.JSONEncoder(default=default)
+        self.chunk_size = chunk_size
 
     def render(self, data, template=None, ctx=None):
-        return self.encoder.encode(data)
+        if self.backend == 'orjson':
+            return orjson.dumps(data, default=self.default)
+        if self.backend == 'ujson':
+            return _utf8(ujson.dumps(data, default=self.default))
+        return _utf8(self.encoder.encode(data))
+
+    def render_iter(self, data, template=None, ctx=None):
+        """Renders `data` as chunks of about `chunk_size` bytes.
+        """
+        if self.backend != 'stdlib':
+            return iter((self.render(data), ))
+        return buffered((_utf8(x) for x in self.encoder.iterencode(data)),
+                        self.chunk_size)
+
+
+class NDJSONRenderer(JSONRenderer):
+    """Renders an iterable to newline delimited JSON, a line per item.
+
+    Items are streamed as they are produced, so `data` can be a generator
+    or a database cursor.
+    """
+    __media_types__ = ('application/x-ndjson', )
+
+    streaming = True
+
+    def render(self, data, template=None, ctx=None):
+        return b''.join(self._lines(data))
+
+    def render_iter(self, data, template=None, ctx=None):
+        """Renders `data` as chunks of about `chunk_size` bytes.  `data` is
+        consumed in the context of the current request.
+        """
+        return buffered(stream_with_context(self._lines(data)),
+                        self.chunk_size)
+
+    def _lines(self, data):
+        render = super(NDJSONRenderer, self).render
+        for item in data:
+            yield render(item) + b'\n'
+
+
+class CSVRenderer(Renderer):
+    """Renders an iterable of rows to CSV.
+
+    Rows are sequences, or mappings whose keys are `fieldnames` or the keys
+    of the first row.  A header line is written for mappings.  Rows are
+    streamed as they are produced, so `data` can be a generator or a
+    database cursor.
+    """
+    __media_types__ = ('text/csv', )
+
+    streaming = True
+
+    def __init__(self, fieldnames=None, chunk_size=8192, **fmtparams):
+        """:param fieldnames: columns of mapping rows.
+        :param chunk_size: approximate size of streamed chunks.
+        :param fmtparams: formatting parameters of :func:`csv.writer`.
+        """
+        super(CSVRenderer, self).__init__()
+        self.fieldnames = fieldnames
+        self.chunk_size = chunk_size
+        self.fmtparams = fmtparams
+
+    def render(self, data, template=None, ctx=None):
+        return b''.join(self._lines(data))
+
+    def render_iter(self, data, template=None, ctx=None):
+        """Renders `data` as chunks of about `chunk_size` bytes.  `data` is
+        consumed in the context of the current request.
+        """
+        return buffered(stream_with_context(self._lines(data)),
+                        self.chunk_size)
+
+    def _lines(self, data):
+        lines = _Lines()
+        writer = csv.writer(lines, **self.fmtparams)
+        fieldnames = self.fieldnames
+        for row in data:
+            if hasattr(row, 'keys'):
+                if fieldnames is None:
+                    fieldnames = list(row.keys())
+                if not lines.written:
+                    writer.writerow([_utf8(x) for x in fieldnames])
+                row = [row.get(x, '') for x in fieldnames]
+            writer.writerow([_utf8(x) for x in row])
+            for line in lines:
+                yield line
+            del lines[:]
+
+
+class _Lines(list):
+    """File-like list that :func:`csv.writer` writes lines to.
+    """
+    written = False
+
+    def write(self, line):
+        self.written = True
+        self.append(line)
+
+
+class BinaryRenderer(Renderer):
+    """Base class of renderers of binary formats.  Rendered :class:`bytes`
+    are handed to the response as is.
+    """
+    def __init__(self, default=encode_default):
+        """:param default: function converts objects the format cannot
+            encode natively, shared with :class:`JSONRenderer`.
+        """
+        super(BinaryRenderer, self).__init__()
+        self.default = default
+
+
+class MsgPackRenderer(BinaryRenderer):
+    """Renders object to MessagePack with :mod:`msgpack`.
+    """
+    __media_types__ = ('application/msgpack', 'application/x-msgpack')
+
+    def __init__(self, default=encode_default):
+        if msgpack is None:
+            raise ImportError('msgpack is not installed')
+        super(MsgPackRenderer, self).__init__(default)
+
+    def render(self, data, template=None, ctx=None):
+        # Native strings of Python 2 are text, so they are packed as raw
+        # strings instead of binary
+        return msgpack.packb(data, default=self.default,
+                             use_bin_type=str is not bytes)
+
+
+class CBORRenderer(BinaryRenderer):
+    """Renders object to CBOR with :mod:`cbor2`.
+
+    Dates and decimals go through `default` like other renderers instead of
+    CBOR tags, and native strings of Python 2 are encoded as text strings
+    unless they are not UTF-8.
+    """
+    __media_types__ = ('application/cbor', )
+
+    #: Types cbor2 encodes natively that are rendered by `default` instead.
+    default_types = (datetime.datetime, datetime.date, decimal.Decimal)
+
+    def __init__(self, default=encode_default):
+        if cbor2 is None:
+            raise ImportError('cbor2 is not installed')
+        super(CBORRenderer, self).__init__(default)
+
+    def _encode_default(self, encoder, value):
+        encoder.encode(self._prepare(self.default(value)))
+
+    def _prepare(self, value):
+        """Replaces values cbor2 would encode natively but differently from
+        other renderers, since its `default` sees unsupported types only.
+        """
+        if isinstance(value, dict):
+            items = ((self._prepare(k), self._prepare(v))
+                     for k, v in value.items())
+            if isinstance(value, collections.OrderedDict):
+                return collections.OrderedDict(items)
+            return dict(items)
+        if isinstance(value, (list, tuple)):
+            return [self._prepare(x) for x in value]
+        if isinstance(value, (set, frozenset)):
+            return type(value)(self._prepare(x) for x in value)
+        if isinstance(value, self.default_types):
+            return self._prepare(self.default(value))
+        if str is bytes and isinstance(value, str):
+            try:
+                return value.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+        return value
+
+    def render(self, data, template=None, ctx=None):
+        return cbor2.dumps(self._prepare(data), default=self._encode_default)
 
 
 class FunctionRenderer(Renderer):
@@ -99,6 +486,22 @@ class FunctionRenderer(Renderer):
         return self.render(*args, **kwargs)
 
 
+def buffered(chunks, size):
+    """Joins small `chunks` into pieces of at least `size` characters.
+    """
+    buf = []
+    length = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+
 def renderer(*media_types):
     """Decorator that creates simple renderer with function.
     """
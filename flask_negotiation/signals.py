@@ -0,0 +1,35 @@
+""":mod:`signals`
+=================
+
+Signals of negotiation, sent only while they have receivers so that
+instrumentation costs nothing when nothing listens.  They need blinker.
+"""
+from timeit import default_timer as timer
+
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+#: Sent by :class:`~flask_negotiation.Render` after rendering a response
+#: with `renderer`, `media_type`, `response`, `size` of the body in bytes
+#: (:const:`None` if streamed) and `timings`, a dictionary of seconds spent
+#: in ``'negotiate'``, parsing `Accept` and choosing the renderer,
+#: ``'render'`` and ``'total'``.  ``'render'`` is missing when nothing was
+#: rendered, such as responses from the response cache and HTTP 304.
+rendered = _signals.signal('negotiation-rendered')
+
+#: Sent by :func:`~flask_negotiation.decorators.provides` with the view
+#: function as sender when the response of the view is finalized, with
+#: `media_type`, `response` and `timings` of ``'negotiate'``, ``'view'`` and
+#: ``'total'``.
+provided = _signals.signal('negotiation-provided')
+
+#: Sent by both before aborting with HTTP 406 (Not Acceptable), with
+#: `accept` header value.
+not_acceptable = _signals.signal('negotiation-not-acceptable')
+
+
+def receiving(signal):
+    """Determines that `signal` has receivers.
+    """
+    return bool(getattr(signal, 'receivers', None))
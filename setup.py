@@ -4,13 +4,47 @@ Flask-Negotiation
 
 Provides better content negotiation for flask.
 """
+import os
+
 import setuptools
-from setuptools import setup
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    cythonize = None
 
 requires = [
     'Flask',
+    'futures; python_version < "3"',
 ]
 
+
+class optional_build_ext(build_ext):
+    """The compiled core of media_type is optional: when it fails to build,
+    the pure Python implementation is used.
+    """
+    def run(self):
+        try:
+            build_ext.run(self)
+        except Exception as e:
+            self.warn('cannot build speedups: %s' % e)
+
+    def build_extension(self, ext):
+        try:
+            build_ext.build_extension(self, ext)
+        except Exception as e:
+            self.warn('cannot build %s: %s' % (ext.name, e))
+
+
+ext_modules = []
+if cythonize is not None and not os.environ.get('FLASK_NEGOTIATION_NO_EXT'):
+    ext_modules = cythonize([
+        Extension('flask_negotiation._speedups',
+                  ['flask_negotiation/_speedups.pyx']),
+    ])
+
 setup(name='Flask-Negotiation',
       version='0.1.9',
       url='http://blog.hardtack.me/',
@@ -18,11 +52,13 @@ setup(name='Flask-Negotiation',
       author_email='6566gun@gmail.com',
       description='Better content negotiation for flask',
       long_description=__doc__,
-      packages=setuptools.find_packages(exclude=('tests', )),
+      packages=setuptools.find_packages(exclude=('tests', 'benchmarks')),
       include_package_data=True,
       zip_safe=False,
       platforms='any',
       install_requires=requires,
+      ext_modules=ext_modules,
+      cmdclass={'build_ext': optional_build_ext},
       classifiers=[
           'Development Status :: 4 - Beta',
           'Environment :: Web Environment',
@@ -1,14 +1,58 @@
 import os
 import json
+import pickle
+import datetime
+import decimal
+import gzip
+import io
+import threading
+import time
+import zlib
 
 import pytest
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from flask import (Flask, Blueprint, request, copy_current_request_context,
+                   render_template)
+from werkzeug.exceptions import RequestEntityTooLarge
 
-from flask_negotiation import provides, Render
+from flask_negotiation import provides, accepts, Render, Negotiation
+from flask_negotiation import media_type as media_type_module
+from flask_negotiation import fragments, signals
+from flask_negotiation.cache import LRUCache, MemoryCache
+from flask_negotiation.compression import Compressor
+from flask_negotiation.metrics import PrometheusMetrics
+from flask_negotiation.offload import OffloadPolicy
+from flask_negotiation.parsers import (json_parser, JSONParser, FormParser,
+                                      MsgPackParser, CBORParser)
 from flask_negotiation.media_type import (MediaType, can_accept,
-                                          choose_media_type)
+                                          choose_media_type,
+                                          acceptable_media_types,
+                                          MediaTypeIndex, parse_accept,
+                                          parse_header, choose_encoding,
+                                          best_renderer, RendererIndex,
+                                          best_renderers, choose_media_types)
 from flask_negotiation.renderers import (renderer, template_renderer,
-                                         json_renderer, TemplateRenderer)
+                                         json_renderer, TemplateRenderer,
+                                         JSONRenderer, MsgPackRenderer,
+                                         CBORRenderer, encode_default,
+                                         NDJSONRenderer, CSVRenderer)
+
+
+@pytest.fixture(autouse=True, params=['python', 'speedups'])
+def core(request):
+    """Runs every test against both implementations of the media type core.
+    """
+    builtin = media_type_module.speedups
+    if request.param == 'speedups' and media_type_module._speedups is None:
+        pytest.skip('speedups are not built')
+    media_type_module.use_speedups(request.param == 'speedups')
+    MediaType.instances.clear()
+    media_type_module.accept_cache.clear()
+    yield request.param
+    media_type_module.use_speedups(builtin)
+    MediaType.instances.clear()
+    media_type_module.accept_cache.clear()
 
 
 @pytest.fixture
@@ -285,3 +329,955 @@ def test_choosing():
         [json_type, html_type],
         map(MediaType, ['text/html', 'application/*'])
     )
+
+
+def test_accept_cache(app):
+    cache = LRUCache(maxsize=2)
+    app.config['NEGOTIATION_ACCEPT_CACHE'] = cache
+    headers = {'Accept': 'application/json; q=0.5, text/html'}
+    with app.test_request_context(headers=headers):
+        first = acceptable_media_types(request)
+        # Parsed once per request
+        assert first is acceptable_media_types(request)
+    with app.test_request_context(headers=headers):
+        second = acceptable_media_types(request)
+    assert first is second
+    assert isinstance(first, tuple)
+    assert ['text/html', 'application/json'] == [x.media_type for x in first]
+    assert 1 == cache.hits and 1 == cache.misses
+
+    for accept in ('image/png', 'image/jpeg', 'text/plain'):
+        with app.test_request_context(headers={'Accept': accept}):
+            acceptable_media_types(request)
+    assert 2 == len(cache)
+    assert 2 == cache.evictions
+    assert {'hits': 1, 'misses': 4, 'evictions': 2,
+            'size': 2, 'maxsize': 2} == cache.stats
+
+    # Disabled
+    app.config['NEGOTIATION_ACCEPT_CACHE'] = False
+    with app.test_request_context(headers=headers):
+        first = acceptable_media_types(request)
+    with app.test_request_context(headers=headers):
+        assert first is not acceptable_media_types(request)
+
+    # Werkzeug's parsed header
+    with app.test_request_context(headers=headers):
+        assert first == acceptable_media_types(request.accept_mimetypes)
+        assert [1.0, 0.5] == [x.quality for x in
+                              acceptable_media_types(request.accept_mimetypes)]
+        assert 'text/html' == choose_media_type(
+            request.accept_mimetypes, map(MediaType, ['text/*']))
+    with app.test_request_context():
+        assert ('*/*', ) == acceptable_media_types(request.accept_mimetypes)
+
+
+def test_accept_cache_limits():
+    strict, lenient = Flask('strict'), Flask('lenient')
+    strict.config['NEGOTIATION_ACCEPT_MAX_ENTRIES'] = 2
+    for app_ in strict, lenient:
+        @app_.route('/')
+        @provides('text/html')
+        def index():
+            return 'OK'
+
+    headers = {'Accept': ', '.join(['text/html'] * 5)}
+    assert 400 == strict.test_client().get('/', headers=headers).status_code
+    assert 200 == lenient.test_client().get('/', headers=headers).status_code
+    assert 400 == strict.test_client().get('/', headers=headers).status_code
+
+
+def test_media_type_index():
+    supported = map(MediaType, ['text/html; level=1', 'application/*',
+                                '*/xml', 'image/png'])
+    index = MediaTypeIndex(supported)
+    accepts = ['text/html', 'text/html; level=1', 'text/html; level=2',
+               'application/json', 'application/*', 'text/xml', '*/*',
+               'image/png', 'image/jpeg', 'image/png; q=0.1']
+    for accept in accepts:
+        acceptable = MediaType(accept)
+        assert [x for x in supported if acceptable in x] == \
+            index.match(acceptable)
+    for accept in ('image/png; q=0.3, application/json; q=0.3, text/xml',
+                   'text/plain, image/png; q=0.3, application/json; q=0.3',
+                   'text/plain, image/gif'):
+        acceptables = [MediaType(x) for x in accept.split(',')]
+        assert choose_media_type(acceptables, supported) is \
+            choose_media_type(acceptables, index)
+    assert can_accept([MediaType('application/json')], index)
+    assert not can_accept([MediaType('image/gif')], index)
+
+
+def test_render_decisions(app):
+    client = app.test_client()
+    render = Render(renderers=[template_renderer, json_renderer])
+
+    @app.route('/decide')
+    def decide():
+        return render({'key': 'value'})
+
+    headers = {'Accept': 'application/json'}
+    assert 'application/json' == client.get('/decide', headers=headers) \
+        .content_type
+    assert 'application/json' == client.get('/decide', headers=headers) \
+        .content_type
+    assert 1 == render.decisions.hits
+    assert 1 == render.decisions.misses
+
+    with app.test_request_context(headers={'Accept': 'text/*, */*; q=0.1'}):
+        chosen, media_type = render.negotiate()
+        assert template_renderer is chosen
+        chosen, media_type = render.negotiate([json_renderer])
+        assert json_renderer is chosen
+        assert 'application/json' == media_type
+    with app.test_request_context(headers={'Accept': 'image/png'}):
+        assert (None, None) == render.negotiate()
+
+    render.renderers = [json_renderer]
+    assert 0 == len(render.decisions)
+    headers = {'Accept': 'text/html'}
+    assert 406 == client.get('/decide', headers=headers).status_code
+
+
+def test_media_type_interning():
+    html_type = MediaType('text/html; level=1; q=0.5')
+    assert html_type is MediaType('text/html; level=1; q=0.5')
+    assert 0.5 == html_type.quality
+    assert (('level', '1'), ('q', '0.5')) == html_type.param_items
+    assert {'level': '1', 'q': '0.5'} == html_type.params
+    assert 'text/html; level=1; q=0.5' == str(html_type)
+    assert html_type is pickle.loads(pickle.dumps(html_type))
+    with pytest.raises(AttributeError):
+        html_type.quality = 1.0
+    with pytest.raises(AttributeError):
+        html_type.extra = None
+
+    assert ('level', '2') in MediaType('text/html;level=1;level=2') \
+        .param_items
+    assert MediaType('text/html') == html_type
+    assert 'text/html' == html_type
+    assert 'text/html' in set([html_type])
+    assert html_type in set(['text/html'])
+    assert 'text/html; level=1' != html_type
+    assert MediaType('text/html') != MediaType('text/plain')
+    assert {MediaType('text/html'): 1}[html_type] == 1
+
+
+def test_accept_tokenizer(app):
+    media_types = parse_accept(
+        'text/html; title="a, b; \\"c\\""; q=0.5, application/json')
+    assert ['application/json', 'text/html'] == \
+        [x.media_type for x in media_types]
+    assert 'a, b; "c"' == media_types[1].get_param('title')
+    assert ('text/plain', {'charset': 'utf-8'}) == \
+        parse_header(' Text/Plain ;charset="utf-8"')
+
+    # Unterminated quote does not swallow following parameters forever
+    assert 1 == len(parse_accept('text/html; x="a, b; c'))
+
+    with pytest.raises(ValueError):
+        parse_accept(', '.join(['text/html'] * 4), max_entries=3)
+    assert 3 == len(parse_accept(', '.join(['text/html'] * 3), 3))
+
+    client = app.test_client()
+
+    @app.route('/limited')
+    @provides('text/html')
+    def limited():
+        return 'OK'
+
+    app.config['NEGOTIATION_ACCEPT_MAX_ENTRIES'] = 4
+    headers = {'Accept': ', '.join(['text/html'] * 5)}
+    assert 400 == client.get('/limited', headers=headers).status_code
+    app.config['NEGOTIATION_ACCEPT_MAX_LENGTH'] = 32
+    headers = {'Accept': 'text/html; q=0.5, text/plain; charset=utf-8'}
+    assert 400 == client.get('/limited', headers=headers).status_code
+    headers = {'Accept': 'text/html; q=high'}
+    assert 400 == client.get('/limited', headers=headers).status_code
+    headers = {'Accept': 'text/html'}
+    assert 200 == client.get('/limited', headers=headers).status_code
+
+
+def test_speedups_equivalence(core):
+    if media_type_module._speedups is None:
+        pytest.skip('speedups are not built')
+    speedups = media_type_module._speedups
+    python = media_type_module._python_core
+    headers = ['', ';', 'text/html', ' Text/HTML ; Q=0.5 ;level=1',
+               'a;x="b;c\\"d";y=e', 'a;x="unterminated;y=z',
+               'a;x="\\\nb;c"', 'a;x="end\\', 'a;x="q\\\\";y',
+               u'text/plain; title="\uc774\ub984"', 'a;=b;c=;d']
+    for header in headers:
+        for separator in ';,':
+            assert python['_split_header'](header, separator) == \
+                speedups.split_header(header, separator)
+        assert python['_parse_header_items'](header) == \
+            speedups.parse_header_items(header)
+    with pytest.raises(ValueError):
+        speedups.split_header('a,b,c', ',', 2)
+    for raw in ['*/*', 'text/*', '*/html', 'text/html', 'text/html;a=1',
+                'text/plain', 'image/*;q=0.1']:
+        for other in ['text/html', 'text/html;a=1', 'image/png', '*/*']:
+            media_type, other = MediaType(raw), MediaType(other)
+            assert python['_contains'](media_type, other) == \
+                speedups.contains(media_type, other)
+
+
+def test_streaming(app, tmpdir):
+    app.template_folder = str(tmpdir)
+    with open(os.path.join(app.template_folder, 'items.html'), 'w') as f:
+        f.write('{% for x in data %}<i>{{ x }}</i>{% endfor %}')
+    client = app.test_client()
+    render = Render(renderers=[TemplateRenderer(chunk_size=16),
+                               JSONRenderer(chunk_size=16)], stream=True)
+    data = range(100)
+
+    @app.route('/stream')
+    def stream():
+        return render(data, 'items')
+
+    @app.route('/whole')
+    def whole():
+        return render(data, 'items', stream=False)
+
+    rv = client.get('/stream', headers={'Accept': 'application/json'})
+    assert 'Content-Length' not in rv.headers
+    assert data == json.loads(rv.data)
+
+    rv = client.get('/stream', headers={'Accept': 'text/html'})
+    assert 'Content-Length' not in rv.headers
+    assert ''.join('<i>%d</i>' % x for x in data) == rv.data
+
+    rv = client.get('/whole', headers={'Accept': 'text/html'})
+    assert 'Content-Length' in rv.headers
+
+    chunks = list(JSONRenderer(chunk_size=16).render_iter(data))
+    assert 1 < len(chunks)
+    assert all(16 <= len(chunk) for chunk in chunks[:-1])
+
+
+@pytest.mark.parametrize('backend', JSONRenderer.backends)
+def test_json_backends(backend):
+    if backend not in JSONRenderer.available:
+        with pytest.raises(ImportError):
+            JSONRenderer(backend=backend)
+        pytest.skip('%s supporting default is not installed' % backend)
+    data = {
+        'at': datetime.datetime(2014, 1, 2, 3, 4, 5),
+        'on': datetime.date(2014, 1, 2),
+        'price': decimal.Decimal('1.10'),
+        'name': u'\uc548\ub155',
+    }
+    expected = {
+        'at': '2014-01-02T03:04:05',
+        'on': '2014-01-02',
+        'price': '1.10',
+        'name': u'\uc548\ub155',
+    }
+    renderer_ = JSONRenderer(backend=backend)
+    rendered = renderer_.render(data)
+    assert isinstance(rendered, bytes)
+    assert expected == json.loads(rendered.decode('utf-8'))
+    assert rendered == b''.join(renderer_.render_iter(data))
+    with pytest.raises(TypeError):
+        renderer_.render(object())
+
+    # Default backend is one that works with encode_default
+    assert JSONRenderer.available[0] == JSONRenderer().backend
+    assert expected == json.loads(JSONRenderer().render(data))
+    assert 'stdlib' == JSONRenderer(json.JSONEncoder()).backend
+    with pytest.raises(ValueError):
+        JSONRenderer(backend='simplejson')
+
+
+def test_etag(app):
+    client = app.test_client()
+    render = Render(renderers=[json_renderer], etag=True)
+    rendered = []
+
+    @renderer('text/plain')
+    def text_renderer(data, template=None, ctx=None):
+        rendered.append(data)
+        return str(data)
+
+    @app.route('/hashed')
+    def hashed():
+        return render({'key': 'value'})
+
+    @app.route('/versioned')
+    def versioned():
+        return render('data', version=3, renderers=[text_renderer,
+                                                    json_renderer],
+                      last_modified=datetime.datetime(2014, 1, 2))
+
+    rv = client.get('/hashed')
+    etag = rv.headers['ETag']
+    assert 200 == rv.status_code
+    rv = client.get('/hashed', headers={'If-None-Match': etag})
+    assert 304 == rv.status_code
+    assert '' == rv.data
+
+    rv = client.get('/versioned', headers={'Accept': 'text/plain'})
+    text_etag = rv.headers['ETag']
+    assert 'data' == rv.data
+    assert 1 == len(rendered)
+    rv = client.get('/versioned', headers={'Accept': 'text/plain',
+                                           'If-None-Match': text_etag})
+    assert 304 == rv.status_code
+    assert text_etag == rv.headers['ETag']
+    assert 1 == len(rendered)
+    rv = client.get('/versioned', headers={
+        'Accept': 'text/plain',
+        'If-Modified-Since': 'Fri, 03 Jan 2014 00:00:00 GMT',
+    })
+    assert 304 == rv.status_code
+    assert 1 == len(rendered)
+
+    # Other variant has another ETag
+    rv = client.get('/versioned', headers={'Accept': 'application/json',
+                                           'If-None-Match': text_etag})
+    assert 200 == rv.status_code
+    assert text_etag != rv.headers['ETag']
+
+
+def test_variant_headers(app):
+    client = app.test_client()
+    cached_renderer = JSONRenderer()
+    cached_renderer.cache_control = 'public, max-age=60'
+    render = Render(renderers=[template_renderer, cached_renderer],
+                    content_location=lambda media_type: '/data.' +
+                    media_type.sub_type)
+
+    @app.route('/data')
+    def data():
+        return render({'key': 'value'}, headers={'Vary': 'Cookie'})
+
+    @app.route('/private')
+    def private():
+        return render({}, headers={'Cache-Control': 'private'},
+                      content_location='/private.json')
+
+    def wrapped(fn):
+        # Decorators above provides see return value of the view
+        def wrapper():
+            body, status = fn()
+            return body, status + 1
+        return wrapper
+
+    @app.route('/provided')
+    @wrapped
+    @provides('application/json')
+    def provided():
+        return '{}', 201
+
+    rv = client.get('/data', headers={'Accept': 'application/json'})
+    assert set(['Cookie', 'Accept']) == \
+        set(x.strip() for x in rv.headers['Vary'].split(','))
+    assert 'public, max-age=60' == rv.headers['Cache-Control']
+    assert rv.headers['Content-Location'].endswith('/data.json')
+
+    rv = client.get('/private', headers={'Accept': 'application/json'})
+    assert 'private' == rv.headers['Cache-Control']
+    assert rv.headers['Content-Location'].endswith('/private.json')
+
+    rv = client.get('/provided', headers={'Accept': 'application/json'})
+    assert 202 == rv.status_code
+    assert 'Accept' == rv.headers['Vary']
+
+
+def test_response_cache(app):
+    client = app.test_client()
+    now = [0]
+    cache = MemoryCache(maxsize=8, ttl=60, clock=lambda: now[0])
+    rendered = []
+
+    @renderer('text/plain')
+    def text_renderer(data, template=None, ctx=None):
+        rendered.append(data)
+        return u'%s' % (data, )
+
+    render = Render(renderers=[text_renderer, json_renderer], cache=cache)
+
+    @app.route('/items/<int:item_id>')
+    def item(item_id):
+        return render({'id': item_id}, cache_key='item:%d' % item_id)
+
+    @app.route('/derived')
+    def derived():
+        return render('derived', cache_key=True, ttl=10)
+
+    for _ in range(3):
+        rv = client.get('/items/1', headers={'Accept': 'text/plain'})
+        assert "{'id': 1}" == rv.data
+    assert 1 == len(rendered)
+    client.get('/items/1', headers={'Accept': 'application/json'})
+    client.get('/items/2', headers={'Accept': 'text/plain'})
+    assert 2 == len(rendered)
+    assert 3 == len(cache)
+
+    assert 2 == render.invalidate_cache('item:1|')
+    client.get('/items/1', headers={'Accept': 'text/plain'})
+    assert 3 == len(rendered)
+
+    client.get('/derived?page=1')
+    client.get('/derived?page=1')
+    client.get('/derived?page=2')
+    assert 5 == len(rendered)
+    now[0] = 11
+    client.get('/derived?page=1')
+    assert 6 == len(rendered)
+    assert 1 == cache.expirations
+    stats = cache.stats
+    assert 3 == stats['hits']
+    assert 0.3 == stats['hit_rate']
+
+    small = MemoryCache(max_bytes=10)
+    small.set('a', b'12345')
+    small.set('b', b'123456')
+    assert 'a' not in small and 6 == small.bytes
+    small.set('c', b'12345678901')
+    assert 'c' not in small
+
+
+def test_compression(app):
+    client = app.test_client()
+    compressor = Compressor(min_size=100)
+    render = Render(renderers=[json_renderer], compress=compressor,
+                    etag=True)
+    data = {'items': range(100)}
+
+    @app.route('/large')
+    def large():
+        return render(data, version=1)
+
+    @app.route('/small')
+    def small():
+        return render({})
+
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    rv = client.get('/large', headers=headers)
+    assert 'gzip' == rv.headers['Content-Encoding']
+    assert set(['Accept', 'Accept-Encoding']) == \
+        set(x.strip() for x in rv.headers['Vary'].split(','))
+    body = gzip.GzipFile(fileobj=io.BytesIO(rv.data)).read()
+    assert data == json.loads(body)
+    assert rv.headers['ETag'].endswith('-gzip"')
+    assert 1 == len(compressor.cache)
+
+    rv = client.get('/large', headers=headers)
+    assert 1 == compressor.cache.hits
+
+    headers['If-None-Match'] = rv.headers['ETag']
+    assert 304 == client.get('/large', headers=headers).status_code
+
+    rv = client.get('/large', headers={'Accept-Encoding': 'deflate'})
+    assert data == json.loads(zlib.decompress(rv.data))
+    rv = client.get('/large', headers={'Accept-Encoding': 'gzip;q=0.5'})
+    assert 'Content-Encoding' not in rv.headers
+    rv = client.get('/large')
+    assert 'Content-Encoding' not in rv.headers
+    rv = client.get('/small', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in rv.headers
+    assert 'Accept-Encoding' in rv.headers['Vary']
+
+    bounded = Compressor(cache_bytes=64)
+    bounded.compress(os.urandom(128), 'gzip')
+    bounded.compress(b'a' * 128, 'gzip')
+    assert 1 == len(bounded.cache) and 64 >= bounded.cache.bytes
+
+    assert 'gzip' == choose_encoding(
+        [MediaType('*')], ['gzip', 'deflate'])
+    assert choose_encoding(
+        [MediaType('gzip; q=0'), MediaType('identity')], ['gzip']) is None
+
+
+def test_offload(app):
+    executor = ThreadPoolExecutor(max_workers=1)
+    policy = OffloadPolicy(executor, threshold=10)
+    render = Render(renderers=[json_renderer], offload=policy)
+    threads = []
+
+    @renderer('text/plain')
+    def slow_renderer(data, template=None, ctx=None):
+        threads.append(threading.current_thread())
+        if data == 'slow':
+            time.sleep(0.2)
+        return u'%s' % (data, )
+
+    try:
+        with app.test_request_context(headers={'Accept': 'text/plain'}):
+            rv = render(range(20), renderers=[slow_renderer])
+            assert str(range(20)) == rv.get_data()
+            assert threading.current_thread() is not threads[-1]
+            render(range(5), renderers=[slow_renderer])
+            assert threading.current_thread() is threads[-1]
+
+            policy.estimators[slow_renderer] = lambda data: 100
+            policy.timeout = 0.05
+            rv = render('slow', renderers=[slow_renderer])
+            assert 'slow' == rv.get_data()
+        stats = policy.stats
+        assert 2 == stats['submitted'] and 1 == stats['completed']
+        assert 1 == stats['timeouts'] and 1 == stats['fallbacks']
+        assert 0 == stats['pending']
+
+        policy.fallback = False
+        with app.test_request_context(headers={'Accept': 'text/plain'}):
+            with pytest.raises(FutureTimeoutError):
+                render('slow', renderers=[slow_renderer])
+        assert 2 == policy.stats['timeouts']
+        assert 0 == policy.stats['pending']
+
+        # Renders on a worker of the pool are not offloaded to it again
+        policy.timeout = None
+        policy.estimators.clear()
+        with app.test_request_context(headers={'Accept': 'text/plain'}):
+            @copy_current_request_context
+            def job():
+                return render(range(20), renderers=[slow_renderer])
+            nested = executor.submit(job)
+            assert str(range(20)) == nested.result(5).get_data()
+        assert 3 == policy.stats['submitted']
+    finally:
+        executor.shutdown(wait=False)
+
+
+def test_renderer_index():
+    def make(*media_types):
+        return renderer(*media_types)(
+            lambda data, template=None, ctx=None: data)
+    renderers = [make('text/html', 'application/xhtml+xml'),
+                 make('application/json', 'application/*'),
+                 make('application/hal+json; profile=x'),
+                 make('text/csv', '*/csv'),
+                 make('image/*'),
+                 make('*/*; level=2'),
+                 make('text/plain; charset=utf-8')]
+    index = RendererIndex(renderers)
+    headers = ['*/*', 'text/*', '*/json', '*/csv', 'application/*',
+               'application/hal+json', 'application/hal+json; profile=x',
+               'application/*; profile=x', 'image/png', 'text/plain',
+               'text/*; charset=utf-8', 'text/markdown; level=2',
+               'video/*', 'text/html; q=0.1, application/json; q=0.1',
+               'image/webp; q=0.5, text/csv; q=0.9, */*; q=0.1',
+               'text/html,application/xhtml+xml,application/xml;q=0.9,'
+               'image/webp,*/*;q=0.8']
+    for header in headers:
+        acceptables = parse_accept(header)
+        for acceptable in acceptables:
+            naive = [(r, r.choose_media_type(acceptable)) for r in renderers]
+            naive = [x for x in naive if x[1] is not None]
+            assert (naive[0] if naive else None) == index.choose(acceptable)
+        assert best_renderer(renderers, acceptables) == \
+            best_renderer(index, acceptables)
+
+    html, json_ = renderers[:2]
+    assert (json_, 'application/json') == \
+        index.best(parse_accept('application/json; q=0.5, video/*'))
+    assert (html, 'text/html') == \
+        index.best(parse_accept('*/json; q=0.5, */*'))
+
+
+def test_binary_renderers(app):
+    class Point(object):
+        def __init__(self, x, y):
+            self.x, self.y = x, y
+
+    def default(obj):
+        if isinstance(obj, Point):
+            return [obj.x, obj.y]
+        return encode_default(obj)
+
+    data = {'point': Point(1, 2), 'on': datetime.date(2014, 1, 2),
+            'at': datetime.datetime(2014, 1, 2, 3, 4, 5),
+            'price': decimal.Decimal('1.10'), 'key': 'value'}
+    expected = {u'point': [1, 2], u'on': u'2014-01-02',
+                u'at': u'2014-01-02T03:04:05', u'price': u'1.10',
+                u'key': u'value'}
+    client = app.test_client()
+    renderers = []
+
+    msgpack = pytest.importorskip('msgpack')
+    renderers.append(MsgPackRenderer(default))
+    cbor2 = pytest.importorskip('cbor2')
+    renderers.append(CBORRenderer(default))
+    render = Render(renderers=renderers)
+
+    @app.route('/binary')
+    def binary():
+        return render(data)
+
+    rv = client.get('/binary', headers={'Accept': 'application/x-msgpack'})
+    assert 'application/x-msgpack' == rv.content_type
+    unpacked = msgpack.unpackb(rv.data, raw=False)
+    assert expected == unpacked
+    # Native strings are text, not binary
+    assert all(isinstance(x, unicode) for x in unpacked)
+    assert isinstance(unpacked['key'], unicode)
+
+    rv = client.get('/binary', headers={'Accept': 'application/cbor'})
+    assert 'application/cbor' == rv.content_type
+    loaded = cbor2.loads(rv.data)
+    assert expected == loaded
+    assert all(isinstance(x, unicode) for x in loaded)
+    assert isinstance(loaded['key'], unicode)
+    assert {u'b': b'\xff'} == cbor2.loads(CBORRenderer().render({'b': '\xff'}))
+    nested = {'dates': [datetime.date(2014, 1, 2)],
+              'prices': (decimal.Decimal('1.10'), )}
+    assert {u'dates': [u'2014-01-02'], u'prices': [u'1.10']} == \
+        cbor2.loads(CBORRenderer().render(nested))
+
+
+def test_accepts(app):
+    client = app.test_client()
+
+    @app.route('/parse', methods=['POST'])
+    @accepts(json_parser, FormParser, max_length=64)
+    def parse(data):
+        return json.dumps(data)
+
+    @app.route('/lines', methods=['POST'])
+    @accepts(JSONParser, stream=True, to='items')
+    def lines(items):
+        return json.dumps(list(items))
+
+    rv = client.post('/parse', data='{"key": "value"}',
+                     content_type='application/json; charset=utf-8')
+    assert {'key': 'value'} == json.loads(rv.data)
+    rv = client.post('/parse', data={'key': 'value'})
+    assert {'key': 'value'} == json.loads(rv.data)
+    rv = client.post('/parse', data='{"key": "value"}',
+                     content_type='text/plain')
+    assert 415 == rv.status_code
+    rv = client.post('/parse', data='{"key": "%s"}' % ('x' * 100),
+                     content_type='application/json')
+    assert 413 == rv.status_code
+    rv = client.post('/parse', data='{"key": ',
+                     content_type='application/json')
+    assert 400 == rv.status_code
+    rv = client.post('/parse', data='{}',
+                     content_type='application/json; q=x')
+    assert 400 == rv.status_code
+    rv = client.post('/parse', data='{}',
+                     content_type='application/json; charset=foo')
+    assert 415 == rv.status_code
+    rv = client.post('/lines', data='{}',
+                     content_type='application/x-ndjson; charset=foo')
+    assert 415 == rv.status_code
+    for charset in 'zlib', 'hex', 'base64':
+        rv = client.post('/parse', data='{}',
+                         content_type='application/json; charset=' + charset)
+        assert 415 == rv.status_code
+    rv = client.post('/parse', data=u'{"key": "\xe9"}'.encode('latin-1'),
+                     content_type='application/json; charset=latin-1')
+    assert {'key': u'\xe9'} == json.loads(rv.data)
+
+    # Content types of requests are not interned
+    content_type = 'multipart/form-data; boundary=unique-boundary'
+    client.post('/parse', data='', content_type=content_type)
+    assert (MediaType, content_type) not in MediaType.instances
+    assert MediaType.parse(content_type) is not \
+        MediaType.parse(content_type)
+
+    rv = client.post('/lines', data='{"n": 1}\n\n{"n": 2}\n[3]',
+                     content_type='application/x-ndjson')
+    assert [{'n': 1}, {'n': 2}, [3]] == json.loads(rv.data)
+
+    msgpack = pytest.importorskip('msgpack')
+    parser = MsgPackParser()
+    body = b''.join(msgpack.packb(x) for x in range(1000))
+    items = list(parser.parse_iter(io.BytesIO(body),
+                                   MediaType('application/msgpack')))
+    assert range(1000) == items
+    with pytest.raises(RequestEntityTooLarge):
+        list(parser.parse_iter(io.BytesIO(body),
+                               MediaType('application/msgpack'),
+                               max_length=100))
+
+    @app.route('/packs', methods=['POST'])
+    @accepts(MsgPackParser, stream=True, to='items')
+    def packs(items):
+        return json.dumps(list(items))
+
+    rv = client.post('/packs', data=msgpack.packb(1) + b'\xc1',
+                     content_type='application/msgpack')
+    assert 400 == rv.status_code
+    rv = client.post('/packs', data=msgpack.packb(1) + msgpack.packb(2),
+                     content_type='application/msgpack')
+    assert [1, 2] == json.loads(rv.data)
+
+    pytest.importorskip('cbor2')
+
+    @app.route('/cbor', methods=['POST'])
+    @accepts(CBORParser)
+    def cbor(data):
+        return json.dumps(data)
+
+    rv = client.post('/cbor', data=b'\xa1aa\x01',
+                     content_type='application/cbor')
+    assert {'a': 1} == json.loads(rv.data)
+    for body in b'', b'\x62a', b'\x1c':
+        rv = client.post('/cbor', data=body, content_type='application/cbor')
+        assert 400 == rv.status_code
+
+
+def test_streaming_collections(app):
+    client = app.test_client()
+    render = Render(renderers=[NDJSONRenderer(chunk_size=64),
+                               CSVRenderer(chunk_size=64)])
+    consumed = []
+
+    def rows(count):
+        for x in range(count):
+            consumed.append(x)
+            yield {'id': x, 'name': u'\uc774\ub984 %d' % x}
+
+    @app.route('/export')
+    def export():
+        return render(rows(100))
+
+    rv = client.get('/export', headers={'Accept': 'application/x-ndjson'})
+    assert 'Content-Length' not in rv.headers
+    lines = rv.data.splitlines()
+    assert 100 == len(lines)
+    assert {'id': 3, 'name': u'\uc774\ub984 3'} == json.loads(lines[3])
+
+    del consumed[:]
+    rv = client.get('/export', headers={'Accept': 'text/csv'})
+    assert 'Content-Length' not in rv.headers
+    lines = rv.data.decode('utf-8').splitlines()
+    assert 101 == len(lines)
+    assert set(['id', 'name']) == set(lines[0].split(','))
+    assert 100 == len(consumed)
+
+    chunks = CSVRenderer(fieldnames=['id'], chunk_size=64).render_iter(
+        rows(1000))
+    del consumed[:]
+    next(chunks)
+    assert len(consumed) < 100
+    assert b'1,2\r\n' == CSVRenderer().render([(1, 2)])
+
+    # Rows are produced in the context of the request
+    def scoped_rows():
+        for x in range(int(request.args['count'])):
+            yield {'id': x}
+
+    @app.route('/scoped')
+    def scoped():
+        return render(scoped_rows())
+
+    # CSV has a header line
+    for accept, count in [('application/x-ndjson', 3), ('text/csv', 4)]:
+        rv = client.get('/scoped?count=3', headers={'Accept': accept})
+        assert 200 == rv.status_code
+        assert count == len(rv.data.splitlines())
+
+
+def test_metrics(app):
+    client = app.test_client()
+    render = Render(renderers=[json_renderer])
+    received = []
+
+    @app.route('/')
+    def index():
+        return render({'a': 1}, etag=True, version=1)
+
+    @app.route('/provided')
+    @provides('text/plain')
+    def provided():
+        return 'plain'
+
+    rv = client.get('/', headers={'Accept': 'application/json'})
+    assert 200 == rv.status_code
+    tag = rv.headers['ETag']
+
+    def on_rendered(sender, timings, **kwargs):
+        received.append(timings)
+
+    metrics = PrometheusMetrics()
+    signals.rendered.connect(on_rendered)
+    try:
+        rv = client.get('/', headers={'Accept': 'application/json'})
+        assert 200 == rv.status_code
+        rv = client.get('/', headers={'Accept': 'text/csv'})
+        assert 406 == rv.status_code
+        rv = client.get('/provided', headers={'Accept': 'text/plain'})
+        assert 200 == rv.status_code
+        # Nothing is rendered for 304
+        rv = client.get('/', headers={'Accept': 'application/json',
+                                      'If-None-Match': tag})
+        assert 304 == rv.status_code
+    finally:
+        metrics.disconnect()
+        signals.rendered.disconnect(on_rendered)
+    assert ['negotiate', 'render', 'total'] == sorted(received[0])
+    assert ['negotiate', 'total'] == sorted(received[1])
+    client.get('/', headers={'Accept': 'text/csv'})
+
+    text = metrics.exposition()
+    labels = '{renderer="JSONRenderer",media_type="application/json"'
+    assert ('flask_negotiation_render_seconds_count%s} 1' % labels) in text
+    assert ('flask_negotiation_response_bytes_sum%s} 8' % labels) in text
+    assert 'flask_negotiation_view_seconds_count{view="provided",' \
+        'media_type="text/plain"} 1' in text
+    assert 'flask_negotiation_not_acceptable_total 1\n' in text
+
+
+def test_extension(app):
+    client = app.test_client()
+    negotiation = Negotiation(renderers=[template_renderer, json_renderer])
+    api = Blueprint('api', __name__)
+    negotiation.override(api, renderers=[json_renderer],
+                         content_location='/api')
+
+    @app.route('/')
+    @negotiation.provides(to='media_type')
+    def index(media_type):
+        return negotiation.render({'type': media_type.media_type},
+                                  ctx={}, headers={'X-Type': media_type})
+
+    @api.route('/')
+    @negotiation.provides()
+    def api_index():
+        return negotiation.render({'api': True})
+
+    app.register_blueprint(api, url_prefix='/api')
+    negotiation.init_app(app)
+
+    renders = app.extensions['negotiation']
+    assert renders[None] is negotiation.get_render(app)
+    assert (json_renderer, ) == negotiation.get_render(app, 'api').renderers
+    render = renders['api']
+
+    rv = client.get('/', headers={'Accept': 'application/json'})
+    assert {'type': 'application/json'} == json.loads(rv.data)
+    rv = client.get('/api/', headers={'Accept': 'application/json'})
+    assert {'api': True} == json.loads(rv.data)
+    assert '/api' == rv.headers['Content-Location']
+    assert 406 == client.get('/api/',
+                             headers={'Accept': 'text/html'}).status_code
+    # provides and render share decisions of the blueprint
+    assert 2 == len(render.decisions)
+
+    # Overrides after init_app apply to initialized applications
+    negotiation.override('api', etag=True)
+    assert renders['api'] is not render
+    rv = client.get('/api/', headers={'Accept': 'application/json'})
+    assert rv.headers['ETag']
+    assert (template_renderer, json_renderer) == renders['api'].renderers
+
+
+def test_batch_negotiation():
+    renderers = [json_renderer, template_renderer]
+    accepts = ['text/html', None, 'image/png', 'text/html',
+               'text/*; q=0.5, application/json', 'application/*; x=1', '']
+    cache = LRUCache()
+    decisions = best_renderers(accepts, renderers, cache=cache)
+    assert [best_renderer(renderers, parse_accept(x)) for x in accepts] == \
+        decisions
+    assert (template_renderer, 'text/html') == decisions[0]
+    assert (None, None) == decisions[2]
+    assert decisions[0] is decisions[3]
+    assert 6 == cache.misses and 0 == cache.hits
+
+    supported = map(MediaType, ['application/json', 'text/*'])
+    index = MediaTypeIndex(supported)
+    chosen = choose_media_types(accepts, index, cache=None)
+    assert [choose_media_type(parse_accept(x), supported)
+            for x in accepts] == chosen
+    assert [u'text/html', None, None] == [
+        x if x is None else unicode(x) for x in chosen[:3]]
+
+    with pytest.raises(ValueError):
+        best_renderers(['text/html, application/json'], renderers,
+                       cache=None, max_entries=1)
+
+
+def test_batch_negotiation_limits(app):
+    client = app.test_client()
+
+    @app.route('/limited')
+    @provides('text/html')
+    def limited():
+        return 'OK'
+
+    header = ', '.join(['text/html'] * 5)
+    best_renderers([header], [template_renderer])
+    app.config['NEGOTIATION_ACCEPT_MAX_ENTRIES'] = 2
+    headers = {'Accept': header}
+    assert 400 == client.get('/limited', headers=headers).status_code
+
+
+def test_template_cache(app, tmpdir):
+    app.template_folder = str(tmpdir)
+    path = os.path.join(app.template_folder, 'page.html')
+    with open(path, 'w') as f:
+        f.write('v1 {{ data }}')
+    with open(os.path.join(app.template_folder, 'other.html'), 'w') as f:
+        f.write('other')
+    renderer_ = TemplateRenderer(auto_reload=False)
+    assert 'v1 a' == renderer_.render('a', 'page')
+    assert 'v1 b' == renderer_.render('b', 'page')
+    assert [(app.jinja_env, 'page')] == renderer_.templates.keys()
+    assert renderer_.get_template('page') is \
+        app.jinja_env.get_template('page.html')
+
+    # Changes are not picked up without auto reload
+    with open(path, 'w') as f:
+        f.write('v2 {{ data }}')
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert 'v1 c' == renderer_.render('c', 'page')
+    renderer_.auto_reload = True
+    assert 'v2 c' == renderer_.render('c', 'page')
+
+    # Warm on init_app
+    warmed = TemplateRenderer()
+    Negotiation(app, renderers=[warmed], warm_templates=True)
+    assert 4 == len(warmed.templates)
+    assert 'other' == warmed.render(None, 'other.html')
+    assert warmed.get_template('page') is \
+        app.jinja_env.get_template('page.html')
+    assert 4 == len(warmed.templates)
+
+    bounded = TemplateRenderer(cache_size=1)
+    bounded.render(None, 'page')
+    bounded.render(None, 'other')
+    assert [(app.jinja_env, 'other')] == bounded.templates.keys()
+
+
+def test_fragment_cache(app, tmpdir):
+    app.template_folder = str(tmpdir)
+    with open(os.path.join(app.template_folder, 'cards.html'), 'w') as f:
+        f.write('{% for item in data %}'
+                '{% cache "card", none, item.id, item.version %}'
+                '<b>{{ item.name }}</b>{{ rendered.append(item.id) or "" }}'
+                '{% endcache %}'
+                '{% endfor %}')
+    rendered = []
+    app.jinja_env.globals['rendered'] = rendered
+    renderer_ = TemplateRenderer(fragment_cache=True)
+    cache = renderer_.fragment_cache
+    Negotiation(app, renderers=[renderer_])
+    assert cache is app.jinja_env.fragment_cache
+    items = [{'id': 1, 'version': 1, 'name': '<a>'},
+             {'id': 2, 'version': 1, 'name': 'b'}]
+
+    assert '<b>&lt;a&gt;</b><b>b</b>' == renderer_.render(items, 'cards')
+    assert [1, 2] == rendered
+    assert '<b>&lt;a&gt;</b><b>b</b>' == renderer_.render(items, 'cards')
+    assert [1, 2] == rendered
+    assert 2 == cache.hits and 2 == cache.misses
+
+    # Only changed fragments render again
+    items[1] = {'id': 2, 'version': 2, 'name': 'c'}
+    assert '<b>&lt;a&gt;</b><b>c</b>' == renderer_.render(items, 'cards')
+    assert [1, 2, 2] == rendered
+
+    assert 3 == cache.delete_prefix(fragments.fragment_key('card'))
+    renderer_.render(items, 'cards')
+    assert [1, 2, 2, 1, 2] == rendered
+
+    # Templates rendered outside negotiation share the blocks
+    assert '<b>&lt;a&gt;</b><b>c</b>' == render_template('cards.html',
+                                                         data=items)
+    assert [1, 2, 2, 1, 2] == rendered